@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.archive
+==============
+
+Move finished activity trees, with their relationships and payloads, from
+the hot tables polled by the engine into the cold archive tables.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from django.db import connection, transaction
+from django.db.models import F
+
+from modbpm import states
+from modbpm.models import (
+    ActivityInputs,
+    ActivityModel,
+    ActivityOutputs,
+    ActivityRelationship,
+    ActivitySnapshot,
+    ActivitySnapshotDelta,
+    ArchivedActivityInputs,
+    ArchivedActivityModel,
+    ArchivedActivityOutputs,
+    ArchivedActivityRelationship,
+    _chunked,
+)
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 400
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _in(ids):
+    return "(%s)" % ', '.join(['%s'] * len(ids))
+
+
+def _copy(cursor, source, target, column, ids, skip_existing=False):
+    """
+    Copy rows of ``source`` whose ``column`` is in ``ids`` to ``target``,
+    which has the same column names.
+    """
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(f.column) for f in target._meta.concrete_fields
+                        if not f.auto_created)
+    sql = "INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN %s" % (
+        _table(target), columns, columns, _table(source), qn(column),
+        _in(ids),
+    )
+    params = list(ids)
+    if skip_existing:
+        sql += " AND id NOT IN (SELECT id FROM %s WHERE id IN %s)" % (
+            _table(target), _in(ids),
+        )
+        params += ids
+    cursor.execute(sql, params)
+
+
+def _delete(cursor, model, column, ids, extra="", params=()):
+    cursor.execute(
+        "DELETE FROM %s WHERE %s IN %s%s" % (
+            _table(model), connection.ops.quote_name(column), _in(ids), extra,
+        ),
+        list(ids) + list(params),
+    )
+
+
+def archivable_roots(before, limit=None):
+    """
+    Primary keys of root activities archived before ``before`` whose
+    whole tree is archived.
+    """
+    unfinished = ActivityModel.objects.exclude(
+        state__in=states.ARCHIVED_STATES
+    ).filter(root__isnull=False).values('root')
+
+    roots = ActivityModel.objects.filter(
+        pk=F('root'),
+        state__in=states.ARCHIVED_STATES,
+        date_archived__lt=before,
+    ).exclude(
+        pk__in=unfinished
+    ).order_by('date_archived').values_list('pk', flat=True)
+
+    return list(roots[:limit] if limit else roots)
+
+
+@transaction.atomic
+def archive_trees(root_ids):
+    """
+    Move the trees of ``root_ids`` into the archive in one transaction.
+
+    Payloads are copied to the archive, but only deleted from the hot
+    tables once no hot activity shares them anymore.
+    """
+    rows = ActivityModel.objects.filter(root__in=root_ids).values_list(
+        'pk', 'inputs_id', 'outputs_id', 'snapshot_id'
+    )
+    act_ids, input_ids, output_ids, snapshot_ids = [], set(), set(), set()
+    for pk, inputs_id, outputs_id, snapshot_id in rows:
+        act_ids.append(pk)
+        input_ids.add(inputs_id)
+        output_ids.add(outputs_id)
+        snapshot_ids.add(snapshot_id)
+    for ids in (input_ids, output_ids, snapshot_ids):
+        ids.discard(None)
+
+    with connection.cursor() as cursor:
+        for chunk in _chunked(input_ids, CHUNK_SIZE):
+            _copy(cursor, ActivityInputs, ArchivedActivityInputs,
+                  'id', chunk, skip_existing=True)
+        for chunk in _chunked(output_ids, CHUNK_SIZE):
+            _copy(cursor, ActivityOutputs, ArchivedActivityOutputs,
+                  'id', chunk, skip_existing=True)
+
+        for chunk in _chunked(act_ids, CHUNK_SIZE):
+            _copy(cursor, ActivityModel, ArchivedActivityModel,
+                  'id', chunk)
+            _copy(cursor, ActivityRelationship, ArchivedActivityRelationship,
+                  'descendant_id', chunk)
+
+        # ancestors of a relationship always belong to the same tree
+        for chunk in _chunked(act_ids, CHUNK_SIZE):
+            _delete(cursor, ActivityRelationship, 'descendant_id', chunk)
+
+        # clear references within the whole tree first, so that chunks
+        # can be deleted in any order
+        for chunk in _chunked(act_ids, CHUNK_SIZE):
+            ActivityModel.objects.filter(pk__in=chunk) \
+                                 .update(parent=None, root=None)
+        for chunk in _chunked(act_ids, CHUNK_SIZE):
+            _delete(cursor, ActivityModel, 'id', chunk)
+
+        for chunk in _chunked(snapshot_ids, CHUNK_SIZE):
+            _delete(cursor, ActivitySnapshotDelta, 'snapshot_id', chunk)
+            _delete(cursor, ActivitySnapshot, 'id', chunk)
+
+        for model, column, ids in ((ActivityInputs, 'inputs_id', input_ids),
+                                   (ActivityOutputs, 'outputs_id',
+                                    output_ids)):
+            for chunk in _chunked(ids, CHUNK_SIZE):
+                _delete(cursor, model, 'id', chunk,
+                        " AND id NOT IN (SELECT %s FROM %s WHERE %s IN %s)"
+                        % (column, _table(ActivityModel), column,
+                           _in(chunk)),
+                        chunk)
+
+    return len(act_ids)
+
+
+def archive(before, batch_size=100, max_batches=None):
+    """
+    Archive finished trees in batches of ``batch_size`` roots, each batch
+    in its own transaction. Returns the number of archived roots.
+    """
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        root_ids = archivable_roots(before, limit=batch_size)
+        if not root_ids:
+            break
+
+        activities = archive_trees(root_ids)
+        logger.info("archived %d trees, %d activities"
+                    % (len(root_ids), activities))
+
+        archived += len(root_ids)
+        batches += 1
+
+    return archived
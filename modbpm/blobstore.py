@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.blobstore
+================
+
+Content-addressed file storage for large encoded payloads.
+"""
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+KEY_LENGTH = 64
+
+
+class FileBlobStore(object):
+    """
+    Store blobs in files named after the sha256 of their content, under
+    ``root`` which may be a local or a shared directory.
+    """
+
+    def __init__(self, root, threshold):
+        self.root = root
+        self.threshold = threshold
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data):
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+
+        if os.path.exists(path):
+            # refresh mtime so that the collector keeps the reused blob
+            os.utime(path, None)
+            return key
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # write to a temporary file first, so readers never see a partial
+        # blob, then move it into place atomically
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        return key
+
+    def open(self, key):
+        """
+        Map the blob into memory, read-only.
+        """
+        with open(self.path(key), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, key, min_age=0):
+        """
+        Delete the blob, unless it was stored or reused within the last
+        ``min_age`` seconds.
+        """
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) > time.time() - min_age:
+                return False
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def keys(self, min_age=0):
+        """
+        Iterate over keys of the stored blobs that are at least
+        ``min_age`` seconds old.
+        """
+        deadline = time.time() - min_age
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if len(filename) != KEY_LENGTH:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.getmtime(path) > deadline:
+                        continue
+                except OSError:
+                    continue
+                yield filename
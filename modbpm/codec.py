@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.codec
+============
+
+Pluggable serializers and compressors for stored activity payloads.
+
+Every encoded value starts with a single header byte::
+
+    1 SSS CCCC
+    | |   |
+    | |   +-- compressor code (0-15)
+    | +------ serializer code (0-7)
+    +-------- always set
+
+Legacy values written before the header existed are plain zlib streams,
+whose first byte is always ``0x78`` (high bit clear), so both formats can
+be told apart and old rows stay readable.
+
+Compressor code ``0x0F`` is reserved for references to values kept in a
+blob store, see :func:`set_blob_store`.
+"""
+from __future__ import absolute_import
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import collections
+import json
+import marshal
+import struct
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+HEADER_FLAG = 0x80
+EXTERNAL_CODE = 0x0F
+
+_SERIALIZERS = {}
+_SERIALIZER_CODES = {}
+_COMPRESSORS = {}
+_COMPRESSOR_CODES = {}
+
+
+def register_serializer(name, code, dumps, loads):
+    """
+    Register a serializer, ``code`` is the 3-bit value written to headers.
+    """
+    if not 0 <= code <= 0x07:
+        raise ValueError("serializer code out of range: %r" % code)
+    if code in _SERIALIZER_CODES and _SERIALIZER_CODES[code][0] != name:
+        raise ValueError("serializer code already registered: %r" % code)
+    _SERIALIZERS[name] = (code, dumps, loads)
+    _SERIALIZER_CODES[code] = (name, dumps, loads)
+
+
+def register_compressor(name, code, compress, decompress):
+    """
+    Register a compressor, ``code`` is the 4-bit value written to headers.
+
+    ``compress`` is called as ``compress(data, level)``, where ``level``
+    may be None for the compressor's own default. It may return None if
+    it can not handle the data, zlib is then used instead.
+    """
+    if not 0 <= code < EXTERNAL_CODE:
+        raise ValueError("compressor code out of range: %r" % code)
+    if code in _COMPRESSOR_CODES and _COMPRESSOR_CODES[code][0] != name:
+        raise ValueError("compressor code already registered: %r" % code)
+    _COMPRESSORS[name] = (code, compress, decompress)
+    _COMPRESSOR_CODES[code] = (name, compress, decompress)
+
+
+def available_serializers():
+    return sorted(_SERIALIZERS)
+
+
+def available_compressors():
+    return sorted(_COMPRESSORS)
+
+
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+try:
+    _view = buffer
+except NameError:
+    def _view(data, offset):
+        return memoryview(data)[offset:]
+
+if bytes is str:
+    # serializers of Python 2 accept strings only
+    _readable = _to_bytes
+else:
+    def _readable(data):
+        return data
+
+
+class Encoded(str):
+    """
+    An already encoded value, stored verbatim by codec-aware fields.
+
+    The original value is kept in :attr:`value` so that it can be restored
+    on the model instance once the row has been written.
+    """
+
+    value = None
+
+
+def unwrap(value):
+    """
+    Return the original value of an :class:`Encoded` value.
+    """
+    if isinstance(value, Encoded):
+        return value.value
+    return value
+
+
+class Codec(object):
+    """
+    A serializer and compressor pair used to encode payloads::
+
+        >>> codec = Codec('pickle', 'zlib', level=1)
+        >>> codec.decode(codec.encode({'a': 1}))
+        {'a': 1}
+
+    Payloads shorter than ``threshold`` bytes after serialization are
+    stored without compression.
+    """
+
+    def __init__(self, serializer='pickle', compressor='zlib', level=None,
+                 threshold=0):
+        if serializer not in _SERIALIZERS:
+            raise ValueError("unknown serializer: %r" % serializer)
+        if compressor not in _COMPRESSORS:
+            raise ValueError("unknown compressor: %r" % compressor)
+
+        self.serializer = serializer
+        self.compressor = compressor
+        self.level = level
+        self.threshold = threshold
+
+    def __repr__(self):
+        return "%s(%r, %r, level=%r, threshold=%r)" % (
+            self.__class__.__name__,
+            self.serializer,
+            self.compressor,
+            self.level,
+            self.threshold,
+        )
+
+    def _compress(self, data):
+        if len(data) < self.threshold:
+            compressor = 'none'
+        else:
+            compressor = self.compressor
+
+        code, compress, _ = _COMPRESSORS[compressor]
+        compressed = compress(data, self.level)
+        if compressed is None:
+            code, compress, _ = _COMPRESSORS['zlib']
+            compressed = compress(data, self.level)
+        return code, compressed
+
+    def encode(self, value):
+        s_code, dumps, _ = _SERIALIZERS[self.serializer]
+        c_code, data = self._compress(dumps(value))
+        data = chr(HEADER_FLAG | (s_code << 4) | c_code) + data
+
+        if _blob_store is not None and len(data) >= _blob_store.threshold:
+            key = _blob_store.put(data)
+            data = chr(HEADER_FLAG | (s_code << 4) | EXTERNAL_CODE) + key
+
+        return data
+
+    def wrap(self, value):
+        """
+        Encode ``value`` ahead of time, see :class:`Encoded`.
+        """
+        encoded = Encoded(self.encode(value))
+        encoded.value = value
+        return encoded
+
+    def decode(self, data):
+        return decode(data)
+
+
+def decode(data, legacy_serializer='pickle'):
+    """
+    Decode data written by any :class:`Codec`, or by the legacy format,
+    which is ``legacy_serializer`` compressed with zlib.
+
+    ``data`` may be any object supporting the buffer protocol, it is read
+    in place rather than copied whenever possible.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    header = ord(data[:1] or '\x00')
+
+    if not header & HEADER_FLAG:
+        loads = _SERIALIZERS[legacy_serializer][2]
+        return loads(zlib.decompress(data))
+
+    if header & 0x0F == EXTERNAL_CODE:
+        if _blob_store is None:
+            raise ValueError("no blob store to read external value from")
+        return decode(_blob_store.open(_to_bytes(_view(data, 1))))
+
+    try:
+        loads = _SERIALIZER_CODES[(header >> 4) & 0x07][2]
+        decompress = _COMPRESSOR_CODES[header & 0x0F][2]
+    except KeyError:
+        raise ValueError("unknown codec header: %#04x" % header)
+
+    return loads(decompress(_view(data, 1)))
+
+
+_blob_store = None
+
+
+def set_blob_store(store):
+    """
+    Set the blob store, values encoded into at least ``store.threshold``
+    bytes are then written to it, and only a reference to them is kept.
+
+    ``store.put(data)`` must return a string key, which ``store.open(key)``
+    turns back into a buffer of the data.
+    """
+    global _blob_store
+
+    _blob_store = store
+
+
+def external_key(data):
+    """
+    Return the blob store key referenced by encoded ``data``, or None.
+    """
+    data = _to_bytes(data)
+    header = ord(data[:1] or '\x00')
+    if header & HEADER_FLAG and header & 0x0F == EXTERNAL_CODE:
+        return data[1:]
+
+
+_dictionary_loader = None
+_dictionary_ttl = 0
+_dictionaries = {}
+# zlib of Python 2 takes no preset dictionary, streams are primed with the
+# dictionary instead, see zdict_compress()
+_primed_compressors = {}  # (dictionary, level) -> compressor
+_primed_decompressors = {}  # dictionary -> decompressor
+_current_dictionary = (0, None)
+
+
+def set_dictionary_loader(loader, ttl=300):
+    """
+    Set the callable used to load preset dictionaries of the ``zdict``
+    compressor.
+
+    ``loader(version)`` must return a ``(version, data)`` tuple, or None if
+    there is no such dictionary, ``version`` None asks for the current one
+    which is then cached for ``ttl`` seconds.
+    """
+    global _dictionary_loader, _dictionary_ttl, _current_dictionary
+
+    _dictionary_loader = loader
+    _dictionary_ttl = ttl
+    _current_dictionary = (0, None)
+    _dictionaries.clear()
+    _primed_compressors.clear()
+    _primed_decompressors.clear()
+
+
+def get_dictionary(version=None):
+    """
+    Get ``(version, data)`` of a preset dictionary, or None.
+    """
+    global _current_dictionary
+
+    if _dictionary_loader is None:
+        return None
+
+    if version is None:
+        expires, current = _current_dictionary
+        if expires > time.time():
+            return current
+        current = _dictionary_loader(None)
+        _current_dictionary = (time.time() + _dictionary_ttl, current)
+        if current is not None:
+            _dictionaries[current[0]] = current[1]
+        return current
+
+    if version not in _dictionaries:
+        loaded = _dictionary_loader(version)
+        if loaded is None:
+            return None
+        _dictionaries[version] = loaded[1]
+    return version, _dictionaries[version]
+
+
+def train_dictionary(samples, size=16384, segment=16):
+    """
+    Build a preset dictionary of at most ``size`` bytes out of the
+    ``segment`` bytes long substrings shared by most of the samples.
+
+    The most common segments are placed at the end of the dictionary,
+    where they are cheapest to reference.
+    """
+    counter = collections.Counter()
+    for sample in samples:
+        counter.update(set(sample[i:i + segment]
+                           for i in range(max(len(sample) - segment, 0) + 1)))
+
+    chosen = []
+    total = 0
+    for seg, count in counter.most_common():
+        if count < 2 or total + len(seg) > size:
+            break
+        chosen.append(seg)
+        total += len(seg)
+
+    return b''.join(reversed(chosen))
+
+
+def _prime(zdict, level=None):
+    compressor = zlib.compressobj(6 if level is None else level)
+    prefix = compressor.compress(zdict) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressor, prefix
+
+
+def zdict_compress(data, zdict, level=None):
+    """
+    Compress ``data`` with zlib using ``zdict`` as preset dictionary.
+
+    The stream starts with ``zdict`` itself, flushed to a byte boundary,
+    so that ``data`` refers to it as if it were a preset dictionary, and
+    only what follows is returned. Primed streams are kept per dictionary
+    and level, and copied for every value.
+    """
+    key = (zdict, level)
+    if key not in _primed_compressors:
+        _primed_compressors[key] = _prime(zdict, level)[0]
+
+    compressor = _primed_compressors[key].copy()
+    return compressor.compress(data) + compressor.flush()
+
+
+def zdict_decompress(data, zdict):
+    """
+    Decompress ``data`` compressed by :func:`zdict_compress` with
+    ``zdict``.
+    """
+    if zdict not in _primed_decompressors:
+        # any stream of zdict leaves the window the same, whatever level
+        # the data was compressed with
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(_prime(zdict)[1])
+        _primed_decompressors[zdict] = decompressor
+
+    decompressor = _primed_decompressors[zdict].copy()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def _zdict_compress(data, level):
+    current = get_dictionary()
+    if current is None:
+        return None
+
+    version, zdict = current
+    return struct.pack('>H', version) + zdict_compress(data, zdict, level)
+
+
+def _zdict_decompress(data):
+    version, = struct.unpack('>H', data[:2])
+    loaded = get_dictionary(version)
+    if loaded is None:
+        raise ValueError("unknown compression dictionary: %r" % version)
+
+    return zdict_decompress(_to_bytes(data[2:]), loaded[1])
+
+
+def wrap(codec, value):
+    """
+    Encode ``value`` with ``codec`` ahead of time, leaving it as is if no
+    codec is given or there is no value.
+    """
+    if codec is None or value is None:
+        return value
+    return codec.wrap(value)
+
+
+register_serializer(
+    'bytes', 0,
+    lambda value: value,
+    _to_bytes,
+)
+register_serializer(
+    'pickle', 1,
+    lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+    lambda data: pickle.loads(_readable(data)),
+)
+register_serializer(
+    'marshal', 2,
+    marshal.dumps,
+    marshal.loads,
+)
+register_serializer(
+    'json', 3,
+    lambda value: json.dumps(value, separators=(',', ':')),
+    lambda data: json.loads(_to_bytes(data)),
+)
+
+register_compressor(
+    'none', 0,
+    lambda data, level: data,
+    lambda data: data,
+)
+register_compressor(
+    'zlib', 1,
+    lambda data, level: zlib.compress(data, 6 if level is None else level),
+    zlib.decompress,
+)
+if lzma is not None:
+    register_compressor(
+        'lzma', 2,
+        lambda data, level: lzma.compress(
+            data, preset=6 if level is None else level),
+        lzma.decompress,
+    )
+register_compressor(
+    'zdict', 3,
+    _zdict_compress,
+    _zdict_decompress,
+)
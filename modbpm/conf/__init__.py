@@ -5,20 +5,30 @@ modbpm.conf
 
 
 class ModBPMSettings(object):
+    """
+    Settings of modbpm, those of the django project take precedence over
+    the defaults of :mod:`modbpm.conf.default_settings`.
+    """
 
     def __init__(self):
         from django.conf import settings as django_settings
         from modbpm.conf import default_settings
 
         self._django_settings = django_settings
-
-        for _setting in dir(default_settings):
-            if _setting == _setting.upper():
-                setattr(self, _setting, getattr(default_settings, _setting))
+        self._defaults = dict(
+            (_setting, getattr(default_settings, _setting))
+            for _setting in dir(default_settings)
+            if _setting == _setting.upper()
+        )
 
     def __getattr__(self, key):
         if key == key.upper():
-            return getattr(self._django_settings, key)
+            try:
+                return getattr(self._django_settings, key)
+            except AttributeError:
+                if key in self._defaults:
+                    return self._defaults[key]
+                raise
         else:
             raise AttributeError("%r object has no attribute %r"
                                  % (self.__class__.__name__, key))
@@ -7,3 +7,46 @@ MODBPM_MIN_SCHEDULE_INTERVAL = 1
 MODBPM_MAX_SCHEDULE_INTERVAL = 3600
 
 MODBPM_ACKNOWLEDGE_COUNTDOWN = 10
+
+# completion times of finished activities learnt by adaptive intervals, and
+# seconds they are cached by each worker process
+MODBPM_ADAPTIVE_INTERVAL_SAMPLES = 200
+MODBPM_ADAPTIVE_INTERVAL_TTL = 300
+
+# due timers fired per transaction, and seconds between two polls
+MODBPM_TIMER_BATCH_SIZE = 500
+MODBPM_TIMER_POLL_INTERVAL = 1
+
+# blocked activities woken up by timers are scheduled by batches of this
+# size in one worker message, 0 to schedule them one by one, and seconds
+# their wakeups may be fired ahead to join a batch
+MODBPM_BATCH_SCHEDULE_SIZE = 0
+MODBPM_BATCH_SCHEDULE_WINDOW = 0
+
+# modules of activity classes registered when a worker process starts,
+# only those and the entry points are allowed in strict mode
+MODBPM_ACTIVITY_MODULES = ()
+MODBPM_ACTIVITY_REGISTRY_STRICT = False
+
+# seconds before an activity is tried again when too many activities of
+# its class are running, see AbstractActivity.max_running
+MODBPM_THROTTLE_COUNTDOWN = 5
+
+# options of engine tasks by routing class of activities, see modbpm.routing
+MODBPM_ROUTES = {}
+MODBPM_DEFAULT_ROUTING_CLASS = None
+
+# activities moved per transaction by subtree pause, revoke and resume
+MODBPM_SUBTREE_CHUNK_SIZE = 500
+
+MODBPM_COMPRESSION_DICTIONARY_TTL = 300
+
+MODBPM_SNAPSHOT_MAX_DELTAS = 16
+
+# bytes of snapshots whose live backends are kept by each worker process
+# between two schedules of their activities, 0 to disable
+MODBPM_BACKEND_CACHE_SIZE = 0
+
+# directory of the file blob store, None to keep all payloads in database
+MODBPM_BLOB_STORE_ROOT = None
+MODBPM_BLOB_STORE_THRESHOLD = 256 * 1024
@@ -13,7 +13,7 @@ from abc import ABCMeta, abstractmethod
 
 from django.db import transaction
 
-from modbpm import status, exceptions, messages
+from modbpm import codec, status, exceptions, messages
 from modbpm.models import ActivityModel
 
 
@@ -21,6 +21,22 @@ class AbstractActivity(object):
 
     __metaclass__ = ABCMeta
 
+    # codecs used to store snapshots and outputs of this activity class,
+    # None means the default codec of the underlying field.
+    snapshot_codec = None
+    outputs_codec = None
+
+    # routing class of engine tasks of this activity class, for example
+    # 'interactive' or 'batch', see modbpm.routing
+    routing_class = None
+
+    # limits of this activity class over all workers, at most max_running
+    # activities running at once and at most max_rate runs per second, a
+    # run being a transition to RUNNING to call on_start() or
+    # on_schedule(). Runs over the limits are deferred.
+    max_running = None
+    max_rate = None
+
     def __init__(self, act_id, act_name):
         self._act_id = act_id
         self._act_name = act_name
@@ -50,7 +66,7 @@ class AbstractActivity(object):
             'pk': self._act_id,
         }
         try:
-            return ActivityModel.objects.get(**query_kwargs)
+            return ActivityModel.objects.probe(**query_kwargs)
         except ActivityModel.DoesNotExist:
             raise RuntimeError(
                 messages.build_message(
@@ -73,6 +89,15 @@ class AbstractActivity(object):
             if tasklet.alive:
                 tasklet.insert()
 
+    def _suspend(self):
+        """
+        Remove tasklets of this activity from the scheduler without killing
+        them, so that they can be resumed in the same process later on.
+        """
+        for tasklet in self._registry:
+            if tasklet.alive:
+                tasklet.remove()
+
     @abstractmethod
     def _schedule(self):
         raise NotImplementedError
@@ -85,6 +110,9 @@ class AbstractActivity(object):
         """
         Finish this activity.
         """
+        data = codec.wrap(self.outputs_codec, data)
+        ex_data = codec.wrap(self.outputs_codec, ex_data)
+
         if status_code:
             raise exceptions.Failed(data, ex_data, status_code)
         else:
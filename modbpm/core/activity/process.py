@@ -6,6 +6,7 @@ modbpm.activity.process
 Implementation of process of BPMN activity.
 """
 import contextlib
+import itertools
 import logging
 import stackless
 
@@ -48,7 +49,7 @@ class ActivityHandler(object):
             'pk': self.process._act_id,
         }
         try:
-            parent = ActivityModel.objects.get(**query_kwargs)
+            parent = ActivityModel.objects.probe(**query_kwargs)
         except ActivityModel.DoesNotExist:
             raise RuntimeError(messages.build_message(
                 messages.ACT_MODEL_NOT_EXIST,
@@ -62,8 +63,11 @@ class ActivityHandler(object):
                 **cleaned_kwargs
             )
 
-            self.identifier_code = act.identifier_code
-            self.token_code = act.token_code
+            self._bind(act)
+
+    def _bind(self, act):
+        self.identifier_code = act.identifier_code
+        self.token_code = act.token_code
 
     @transaction.atomic  # prevent phantom reads
     def _get_model(self):
@@ -75,7 +79,7 @@ class ActivityHandler(object):
                 'token_code__isnull': False,
             }
             try:
-                return ActivityModel.objects.get(**query_kwargs)
+                return ActivityModel.objects.probe(**query_kwargs)
             except ActivityModel.DoesNotExist:
                 logger.info(
                     messages.build_message(
@@ -85,38 +89,52 @@ class ActivityHandler(object):
                 )
 
     def join(self):
-        while True:
-            model = self._get_model()
-            if isinstance(model, ActivityModel) \
-                    and model.state == states.FINISHED:
-                return model
-            else:
-                stackless.schedule()
+        return self.process._wait(self)
 
     def read(self):
         model = self.join()
         return model.data
 
 
+class Completions(object):
+    """
+    Finished child activities of a process, as far as its waiting
+    tasklets are concerned.
+    """
+
+    def __init__(self):
+        self.finished = None  # children_finished of the process last seen
+        self.models = {}
+        self.waiting = set()
+        self.checked = set()
+
+
 class DefaultScheduleMixin(object):
 
+    # finished children are loaded by _schedule() for all waiting tasklets
+    _collects_completions = True
+
     def _schedule(self):
+        # counters of children are written by other workers, read them
+        # again on every turn
+        ActivityModel.objects.forget(self._act_id)
         model = self._get_model()
         if model.state in states.ARCHIVED_STATES:
             return False
 
-        finished_handler_num = 0
-        archived_handler_num = 0
-        blocked_handler_num = 0
-        for handler, name in self._handler_registry.iteritems():
-            sub_act_model = handler._get_model()
-            if sub_act_model is not None:
-                if sub_act_model.state in states.ARCHIVED_STATES:
-                    archived_handler_num += 1
-                if sub_act_model.state == states.FINISHED:
-                    finished_handler_num += 1
-            else:
-                blocked_handler_num += 1
+        # tasklets given their children may wait for other ones, which
+        # may have finished already, let them run again
+        if self._collect_completions(model):
+            return True
+
+        # children are counted on the row of this activity as they are
+        # created and archived, handlers without a child model yet are
+        # still blocked by their predecessors.
+        finished_handler_num = model.children_finished
+        archived_handler_num = model.children_archived
+        blocked_handler_num = max(
+            len(self._handler_registry) - model.children_created, 0
+        )
 
         logger.info('activity #%d finished: %d, archived: %d blocked: %d',
                     self._act_id,
@@ -167,17 +185,88 @@ class AbstractProcess(AbstractActivity):
 
     __metaclass__ = ABCMeta
 
+    _collects_completions = False
+
     def __init__(self, *args, **kwargs):
         super(AbstractProcess, self).__init__(*args, **kwargs)
 
         self._handler_registry = {}
 
+    def __getstate__(self):
+        # finished children are looked up again once restored
+        state = self.__dict__.copy()
+        state.pop('_completions', None)
+        return state
+
     def _register(self, obj, name, obj_type=None):
         if obj_type:
             getattr(self, '_%s_registry' % obj_type)[obj] = name
         else:
             super(AbstractProcess, self)._register(obj, name)
 
+    def _get_completions(self):
+        return self.__dict__.setdefault('_completions', Completions())
+
+    def _wait(self, handler):
+        """
+        等待handler对应的子活动结束并返回其模型。_schedule会统一加载已结束的
+        子活动时，等待期间不查询数据库，否则每次等待都直接查询一次。
+        """
+        # completions are not part of snapshots, so they are never kept
+        # in a local variable across stackless.schedule()
+        while True:
+            identifier_code = getattr(handler, 'identifier_code', None)
+            model = self._get_completions().models.get(identifier_code)
+            if model is None and identifier_code \
+                    and not self._collects_completions:
+                model = self._get_completion(identifier_code)
+            if model is not None:
+                self._get_completions().waiting.discard(identifier_code)
+                return model
+
+            if identifier_code:
+                self._get_completions().waiting.add(identifier_code)
+            stackless.schedule()
+
+    def _get_completion(self, identifier_code):
+        return ActivityModel.objects.only(
+            *ActivityModel.objects.PROBE_FIELDS
+        ).filter(
+            parent=self._act_id,
+            identifier_code=identifier_code,
+            token_code__isnull=False,
+            state=states.FINISHED,
+        ).first()
+
+    def _collect_completions(self, model):
+        """
+        根据本活动的子活动计数，一次性加载被等待且已结束的子活动。
+        计数未变化时只检查新增的等待对象。有新加载的子活动时返回True。
+        """
+        completions = self._get_completions()
+        if model.children_finished != completions.finished:
+            completions.finished = model.children_finished
+            completions.checked = set()
+        codes = list(completions.waiting - completions.checked)
+        if not codes:
+            return False
+
+        collected = False
+        for i in xrange(0, len(codes), 500):
+            children = ActivityModel.objects.only(
+                *ActivityModel.objects.PROBE_FIELDS
+            ).filter(
+                parent=self._act_id,
+                identifier_code__in=codes[i:i + 500],
+                token_code__isnull=False,
+                state=states.FINISHED,
+            )
+            for child in children:
+                completions.models[child.identifier_code] = child
+                collected = True
+        completions.checked.update(codes)
+        return collected
+
     def is_parallel(self):
         return getattr(self, '_parallel', False)
 
@@ -191,6 +280,56 @@ class AbstractProcess(AbstractActivity):
             predecessors=predecessors,
         )
 
+    def start_many(self, activity, args_list, kwargs_list=None,
+                   predecessors=None):
+        """
+        启动多个同类子活动，每组参数对应一个子活动。所有子活动在同一个事务中批量创建。
+
+        :param activity: 子活动的类
+        :param args_list: 每个子活动的位置参数列表
+        :type args_list: list
+        :param kwargs_list: 每个子活动的关键字参数列表，长度与args_list相同
+        :type kwargs_list: list
+        :param predecessors: 所有子活动的前置活动
+        :return: 子活动的handler列表，顺序与参数相同
+        """
+        assert issubclass(activity, AbstractActivity)
+        args_list = list(args_list)
+        if kwargs_list is None:
+            kwargs_list = [{}] * len(args_list)
+        assert len(kwargs_list) == len(args_list)
+
+        name = '%s.%s' % (activity.__module__, activity.__name__)
+        handlers = [ActivityHandler(process=self,
+                                    name=name,
+                                    predecessors=predecessors)
+                    for _ in args_list]
+
+        self._register(stackless.tasklet(self._start_many)(
+            handlers, args_list, kwargs_list, predecessors
+        ), name)
+
+        if not getattr(self, '_is_parallel', False):
+            join(*handlers)
+
+        return handlers
+
+    def _start_many(self, handlers, args_list, kwargs_list, predecessors):
+        specs = []
+        for handler, args, kwargs in zip(handlers, args_list, kwargs_list):
+            cleaned_args, cleaned_kwargs = clean(*args, **kwargs)
+            specs.append((handler.name,
+                          tuple(cleaned_args),
+                          cleaned_kwargs))
+
+        if isinstance(predecessors, (list, tuple)):
+            join(*predecessors)
+
+        parent = self._get_model()
+        acts = ActivityModel.objects.create_models(parent, specs)
+        for handler, act in zip(handlers, acts):
+            handler._bind(act)
+
     def finish(self, data=None, ex_data=None, return_code=0):
         """
         把过程的状态设置为已结束，并提供返回值。虽然本调用后面的语句仍然会被执行，但是不推荐这么做。
@@ -249,16 +388,22 @@ class AbstractBaseProcess(DefaultScheduleMixin, AbstractProcess):
 
 
 def clean(*args, **kwargs):
+    # wait for all of the handlers, then load their outputs in one query
+    handlers = [v for v in itertools.chain(args, kwargs.itervalues())
+                if isinstance(v, ActivityHandler)]
+    models = dict((handler, handler.join()) for handler in handlers)
+    ActivityModel.objects.load_payloads(models.values(), 'outputs')
+
     cleaned_args = []
     for arg in args:
         if isinstance(arg, ActivityHandler):
-            arg = arg.read()
+            arg = models[arg].data
         cleaned_args.append(arg)
 
     cleaned_kwargs = {}
     for k, v in kwargs.iteritems():
         if isinstance(v, ActivityHandler):
-            v = v.read()
+            v = models[v].data
         cleaned_kwargs[k] = v
 
     return cleaned_args, cleaned_kwargs
@@ -6,14 +6,19 @@ modbpm.activity.task
 Implementation of task of BPMN activity.
 """
 import logging
+import random
 import stackless
+import time
 import types
 
 from abc import ABCMeta
 
+from django.utils.timezone import now
+
 from modbpm import states, status
 from modbpm.conf import settings
 from modbpm.core.activity import AbstractActivity
+from modbpm.models import ActivityModel
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +52,24 @@ class AbstractTask(AbstractActivity):
     def set_null_scheduler(self, on_schedule):
         self.set_scheduler(on_schedule, NullIntervalGenerator())
 
+    def set_exponential_scheduler(self, on_schedule, base=None, cap=None):
+        self.set_scheduler(on_schedule,
+                           ExponentialIntervalGenerator(base, cap))
+
+    def set_deadline_scheduler(self, on_schedule, deadline, interval=None):
+        self.set_scheduler(on_schedule,
+                           DeadlineIntervalGenerator(deadline, interval))
+
+    def set_adaptive_scheduler(self, on_schedule):
+        # measured from creation, like the completion times learned from
+        created = ActivityModel.objects.filter(
+            pk=self._act_id,
+        ).values_list('date_created', flat=True)[0]
+        self.set_scheduler(on_schedule, AdaptiveIntervalGenerator(
+            self._act_name,
+            age=(now() - created).total_seconds(),
+        ))
+
     def set_scheduler(self, on_schedule, interval):
         assert isinstance(on_schedule, types.MethodType)
         assert self is getattr(on_schedule, 'im_self')
@@ -115,3 +138,106 @@ class StaticIntervalGenerator(object):
     def next(self):
         self.count += 1
         return self.interval
+
+
+class ExponentialIntervalGenerator(object):
+    """
+    指数增长的轮询间隔，带去相关抖动：每次在 base 与上次间隔的三倍之间随机取值，
+    不超过 cap。同时启动的大量任务因此不会同步轮询。
+    """
+
+    def __init__(self, base=None, cap=None):
+        self.count = 0
+        self.base = base or settings.MODBPM_MIN_SCHEDULE_INTERVAL
+        self.cap = cap or settings.MODBPM_MAX_SCHEDULE_INTERVAL
+        self.interval = self.base
+
+    def next(self):
+        self.count += 1
+        self.interval = min(self.cap,
+                            random.uniform(self.base, self.interval * 3))
+        return self.interval
+
+
+class DeadlineIntervalGenerator(object):
+    """
+    按 interval 给出的间隔轮询（默认为 :class:`ExponentialIntervalGenerator` ），
+    但不越过 deadline 秒，保证在 deadline 时刻轮询一次；过了 deadline 之后照常轮询。
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, deadline, interval=None):
+        self.count = 0
+        self.deadline = self.clock() + deadline
+        self.interval = interval or ExponentialIntervalGenerator()
+
+    def next(self):
+        self.count += 1
+        countdown = self.interval.next()
+        remaining = self.deadline - self.clock()
+        if countdown is None or remaining <= 0:
+            return countdown
+        return min(countdown, remaining)
+
+
+_completion_times = {}  # activity name -> (expires, completion times)
+
+
+def completion_times(name):
+    """
+    同类活动最近的完成时间（秒，升序），每个进程缓存
+    MODBPM_ADAPTIVE_INTERVAL_TTL 秒。
+    """
+    expires, times = _completion_times.get(name, (0, None))
+    if expires <= time.time():
+        times = ActivityModel.objects.completion_times(
+            name,
+            settings.MODBPM_ADAPTIVE_INTERVAL_SAMPLES,
+        )
+        _completion_times[name] = (
+            time.time() + settings.MODBPM_ADAPTIVE_INTERVAL_TTL,
+            times,
+        )
+    return times
+
+
+class AdaptiveIntervalGenerator(object):
+    """
+    按同类活动的历史完成时间轮询：在完成时间分布的各个分位点轮询，
+    任务越可能在某个时刻前后完成，那里的轮询就越密集。
+
+    历史数据不足，或者已经超过了所有分位点时，按 interval 给出的间隔轮询
+    （默认为 :class:`ExponentialIntervalGenerator` ）。
+
+    完成时间从活动创建时算起，包含排队和限流等待的时间，因此 age 应为活动
+    创建至今的秒数，两者从同一时刻算起。
+    """
+
+    QUANTILES = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+    MIN_SAMPLES = 10
+    JITTER = 0.1
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, name, interval=None, age=0):
+        self.count = 0
+        self.name = name
+        self.started = self.clock() - age
+        self.interval = interval or ExponentialIntervalGenerator()
+
+    def completion_times(self):
+        return completion_times(self.name)
+
+    def next(self):
+        self.count += 1
+        times = self.completion_times()
+        if len(times) >= self.MIN_SAMPLES:
+            elapsed = self.clock() - self.started
+            for quantile in self.QUANTILES:
+                target = times[int(quantile * (len(times) - 1))]
+                if target > elapsed:
+                    # poll a bit after the quantile, spread over the fleet
+                    return target * random.uniform(1, 1 + self.JITTER) \
+                        - elapsed
+        return self.interval.next()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.local
+============
+
+An engine running activities in the current process, without broker nor
+celery workers, for small workflows and integration tests::
+
+    with LocalEngine(workers=4) as engine:
+        ActivityModel.objects.create_model('myapp.activities.Process', None)
+        engine.wait(timeout=60)
+
+Engine tasks are the very same as those run by celery workers, they go
+through the states and transitions of :mod:`modbpm.states` alike, but are
+handed to a pool of threads instead of being published. Timers are still
+written to :class:`~modbpm.models.ActivityTimer`, the engine keeps their
+due times in memory and fires them when due instead of polling.
+
+Worker threads use connections of their own, the database must be shared
+between connections, which in-memory SQLite databases are not, and rows
+written by uncommitted transactions, e.g. those of ``TestCase``, are not
+seen by workers. SQLite databases allow only one writer at once, use a
+single worker with them.
+
+With ``workers=0`` tasks are rather run one after another in the thread
+calling :meth:`LocalEngine.wait`, with its connection, so that tests can
+use the engine inside their transactions::
+
+    engine = LocalEngine(workers=0)
+    with engine:
+        ActivityModel.objects.create_model('myapp.activities.Process', None)
+        self.assertTrue(engine.wait(timeout=60))
+
+Due timers are then fired by :meth:`LocalEngine.wait` as well, which
+sleeps until they are due.
+"""
+from __future__ import absolute_import
+
+import calendar
+import collections
+import heapq
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+from django.utils import timezone
+
+from modbpm import signals, tasks
+from modbpm.models import ActivityTimer
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_UID = __name__.replace('.', '_')
+
+
+def _timestamp(value):
+    if timezone.is_naive(value):
+        seconds = time.mktime(value.timetuple())
+    else:
+        seconds = calendar.timegm(value.utctimetuple())
+    return seconds + value.microsecond / 1e6
+
+
+class LocalEngine(object):
+    """
+    Run engine tasks in a pool of ``workers`` threads of this process, or
+    in the thread calling :meth:`wait` with ``workers=0``.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+
+        self._pool = None
+        self._timer_thread = None
+        self._queue = collections.deque()  # tasks run inline
+        self._timers = []  # heap of due timestamps
+        self._pending = 0  # submitted tasks not finished yet
+        self._running = False
+        self._condition = threading.Condition()
+        self._previous_executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start the engine, engine tasks of this process are run by it
+        until :meth:`stop` is called.
+        """
+        self._running = True
+        if self.workers:
+            self._pool = ThreadPool(self.workers)
+            self._timer_thread = threading.Thread(target=self._fire_timers,
+                                                  name='modbpm-timers')
+            self._timer_thread.daemon = True
+            self._timer_thread.start()
+
+        signals.timer_scheduled.connect(self._timer_scheduled,
+                                        dispatch_uid=DISPATCH_UID)
+        self._previous_executor = tasks.set_executor(self)
+
+        # timers written before the engine started
+        self._push_next_timer()
+
+    def stop(self):
+        """
+        Stop firing timers, and stop the engine once the submitted tasks
+        are done, tasks are then handed to the executor replaced by
+        :meth:`start` again, or published to celery. Pending timers are
+        left to :func:`modbpm.tasks.fire_timers`.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._timer_thread is not None:
+            self._timer_thread.join()
+        self._run_queue()
+
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+            self._timers = []
+
+        tasks.set_executor(self._previous_executor)
+        self._previous_executor = None
+        signals.timer_scheduled.disconnect(dispatch_uid=DISPATCH_UID)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def submit(self, task, args):
+        """
+        Run engine task ``task`` with ``args`` in a worker thread, or queue
+        it to be run by :meth:`wait`.
+        """
+        with self._condition:
+            self._pending += 1
+            if not self.workers:
+                self._queue.append((task, args))
+                return
+        self._pool.apply_async(self._run, (task, args))
+
+    def wait(self, timeout=None):
+        """
+        Wait until no task nor timer is pending anymore, returns False on
+        timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        if not self.workers:
+            return self._wait_inline(deadline)
+
+        with self._condition:
+            while self._pending or self._timers:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def _wait_inline(self, deadline):
+        while True:
+            self._run_queue()
+            if not self._timers:
+                return True
+
+            delay = self._timers[0] - time.time()
+            if deadline is not None and time.time() + delay > deadline:
+                return False
+            if delay > 0:
+                time.sleep(delay)
+
+            now = time.time()
+            while self._timers and self._timers[0] <= now:
+                heapq.heappop(self._timers)
+            self._fire()
+
+    def _run_queue(self):
+        while self._queue:
+            task, args = self._queue.popleft()
+            self._run(task, args)
+
+    def _run(self, task, args):
+        try:
+            task(*args)
+        except Exception:
+            logger.exception("task %s%r failed"
+                             % (getattr(task, 'name', task), args))
+        finally:
+            # connections of worker threads are not closed by requests
+            if self.workers:
+                connection.close()
+            with self._condition:
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def _timer_scheduled(self, sender, activity_id, to_state, due, **kwargs):
+        self._push(_timestamp(due))
+
+    def _push(self, timestamp):
+        with self._condition:
+            heapq.heappush(self._timers, timestamp)
+            self._condition.notify_all()
+
+    def _push_next_timer(self):
+        due = ActivityTimer.objects.order_by('due') \
+                                   .values_list('due', flat=True)[:1]
+        for value in due:
+            self._push(_timestamp(value))
+
+    def _fire(self):
+        try:
+            tasks.fire_timers()
+        except Exception:
+            logger.exception("firing timers failed")
+            self._push(time.time() + 1)
+        else:
+            # postponed timers are not scheduled again
+            self._push_next_timer()
+
+    def _fire_timers(self):
+        while True:
+            with self._condition:
+                while self._running and not (
+                        self._timers and self._timers[0] <= time.time()):
+                    timeout = None
+                    if self._timers:
+                        timeout = self._timers[0] - time.time()
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+
+                # all due timers are fired at once
+                now = time.time()
+                while self._timers and self._timers[0] <= now:
+                    heapq.heappop(self._timers)
+
+                # counted before the lock is released, wait() must not
+                # return before the timers are fired
+                self._pending += 1
+
+            # by the pool, this thread only keeps time; fires may overlap
+            # each other and other tasks, fire_timers() locks the timers
+            self._pool.apply_async(self._run, (self._fire, ()))
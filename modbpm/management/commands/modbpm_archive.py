@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_archive
+=========================================
+
+Move finished activity trees into the archive tables.
+"""
+from __future__ import absolute_import
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from modbpm import archive
+
+
+class Command(BaseCommand):
+    help = "Move finished activity trees into the archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=7,
+                            help="archive trees finished this many days ago")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="trees moved per transaction")
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="stop after this many batches")
+
+    def handle(self, *args, **options):
+        before = now() - datetime.timedelta(days=options['days'])
+        archived = archive.archive(before,
+                                   batch_size=options['batch_size'],
+                                   max_batches=options['max_batches'])
+        self.stdout.write("archived %d activity trees" % archived)
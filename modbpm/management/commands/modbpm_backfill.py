@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_backfill
+==========================================
+
+Fill in the denormalized columns of activities written by older versions.
+"""
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from modbpm.models import ActivityModel, ActivityRelationship
+
+
+class Command(BaseCommand):
+    help = ("Fill in the parents and roots of activities written before "
+            "they were denormalized, out of the closure table, then count "
+            "the children of their parents. Run it once after upgrading, "
+            "it may be interrupted and run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="primary keys updated per transaction")
+
+    def handle(self, *args, **options):
+        count = ActivityRelationship.objects.backfill(options['chunk_size'])
+        self.stdout.write("filled in parents and roots of %d activities"
+                          % count)
+
+        count = ActivityModel.objects.backfill_counters(options['chunk_size'])
+        self.stdout.write("counted the children of %d activities" % count)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_benchmark_closure
+===================================================
+
+Compare closure-table maintenance cost across tree depths.
+"""
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from modbpm import tasks
+from modbpm.models import ActivityModel, ActivityRelationship
+
+
+class Rollback(Exception):
+    pass
+
+
+def python_attach(parent, activity):
+    """
+    Build the relationships of ``activity`` in python, one object per
+    ancestor of ``parent``, as it used to be done.
+    """
+    rels = [ActivityRelationship(ancestor=parent,
+                                 descendant=activity,
+                                 distance=1)]
+    for rel in parent.ancestor_set.all():
+        rels.append(ActivityRelationship(ancestor=rel.ancestor,
+                                         descendant=activity,
+                                         distance=(rel.distance + 1)))
+    ActivityRelationship.objects.bulk_create(rels)
+
+
+def set_based_attach(parent, activity):
+    ActivityRelationship.objects.attach(parent.pk, [activity.pk])
+
+
+class Command(BaseCommand):
+    help = ("Compare closure-table maintenance cost across tree depths, "
+            "all rows are rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depths', default='1,10,50,100,200',
+                            help="comma separated tree depths")
+        parser.add_argument('--number', type=int, default=50,
+                            help="leaves inserted per depth and method")
+
+    def build_chain(self, depth):
+        parent = ActivityModel.objects.create(name='benchmark.Root')
+        for _ in range(depth - 1):
+            activity = ActivityModel.objects.create(name='benchmark.Node',
+                                                    parent=parent)
+            set_based_attach(parent, activity)
+            parent = activity
+        return parent
+
+    def measure(self, parent, attach, number):
+        start = time.time()
+        for _ in range(number):
+            activity = ActivityModel.objects.create(name='benchmark.Leaf',
+                                                    parent=parent)
+            attach(parent, activity)
+        return (time.time() - start) * 1e3 / number
+
+    def handle(self, *args, **options):
+        depths = [int(d) for d in options['depths'].split(',')]
+        number = options['number']
+
+        row = "%8s %14s %14s"
+        self.stdout.write(row % ('depth', 'python(ms)', 'set-based(ms)'))
+
+        # signals of transitions must not publish engine tasks
+        previous = tasks.set_executor(tasks.NullExecutor())
+        try:
+            with transaction.atomic():
+                for depth in depths:
+                    parent = self.build_chain(depth)
+                    self.stdout.write(row % (
+                        depth,
+                        '%.2f' % self.measure(parent, python_attach, number),
+                        '%.2f' % self.measure(parent, set_based_attach,
+                                              number),
+                    ))
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            tasks.set_executor(previous)
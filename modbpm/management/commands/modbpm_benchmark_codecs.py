@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_benchmark_codecs
+==================================================
+
+Compare CPU cost and stored size of payload codecs.
+"""
+from __future__ import absolute_import
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from modbpm import codec
+from modbpm.models import ActivityOutputs, ActivitySnapshot
+
+
+def sample_outputs():
+    """
+    Build an outputs-like payload: a small dict of hosts and results.
+    """
+    rnd = random.Random(0)
+    return {
+        'hosts': ['10.0.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255))
+                  for _ in range(20)],
+        'result': dict(('job-%d' % i, rnd.choice(['ok', 'failed', 'skip']))
+                       for i in range(20)),
+        'status_code': 0,
+        'message': u"执行完成",
+    }
+
+
+def sample_snapshot():
+    """
+    Build a snapshot-like payload: a pickled object graph.
+    """
+    rnd = random.Random(1)
+    registry = dict(('example.tasks.Task%d' % i, {
+        'identifier_code': '%032x' % rnd.getrandbits(128),
+        'token_code': '%06x' % rnd.getrandbits(24),
+        'schedule_count': rnd.randint(1, 30),
+    }) for i in range(200))
+    return pickle.dumps({'_act_id': 1, '_registry': registry})
+
+
+class Command(BaseCommand):
+    help = "Compare CPU cost and stored size of payload codecs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200,
+                            help="rounds per codec and payload")
+        parser.add_argument('--sample', type=int, default=0,
+                            help="also benchmark the latest N stored rows")
+
+    def get_payloads(self, sample):
+        payloads = [
+            ('outputs', 'pickle', [sample_outputs()]),
+            ('snapshot', 'bytes', [sample_snapshot()]),
+        ]
+        if sample:
+            outputs = ActivityOutputs.objects.order_by('-pk')[:sample]
+            snapshots = ActivitySnapshot.objects.order_by('-pk')[:sample]
+            payloads.extend([
+                ('stored outputs', 'pickle', [o.data for o in outputs]),
+                ('stored snapshot', 'bytes', [s.content for s in snapshots]),
+            ])
+        return [p for p in payloads if p[2]]
+
+    def get_codecs(self, serializer):
+        if serializer == 'bytes':
+            serializers = ['bytes']
+        else:
+            serializers = [s for s in codec.available_serializers()
+                           if s != 'bytes']
+
+        codecs = []
+        for s in serializers:
+            codecs.append(codec.Codec(s, 'none'))
+            for level in (1, 6, 9):
+                codecs.append(codec.Codec(s, 'zlib', level=level))
+            codecs.append(codec.Codec(s, 'zlib', level=6, threshold=512))
+            if 'lzma' in codec.available_compressors():
+                codecs.append(codec.Codec(s, 'lzma', level=1))
+            if codec.get_dictionary() is not None:
+                codecs.append(codec.Codec(s, 'zdict', level=6))
+        return codecs
+
+    def handle(self, *args, **options):
+        number = options['number']
+
+        row = "%-16s %-48s %10s %12s %12s"
+        self.stdout.write(row % ('payload', 'codec', 'bytes',
+                                 'encode(us)', 'decode(us)'))
+
+        for label, serializer, values in self.get_payloads(options['sample']):
+            for c in self.get_codecs(serializer):
+                try:
+                    encoded = [c.encode(v) for v in values]
+                except (TypeError, ValueError):
+                    # e.g. marshal or json can not handle this payload
+                    continue
+
+                size = sum(len(e) for e in encoded)
+                encode_time = timeit.timeit(
+                    lambda: [c.encode(v) for v in values], number=number)
+                decode_time = timeit.timeit(
+                    lambda: [codec.decode(e) for e in encoded], number=number)
+
+                per_value = 1e6 / (number * len(values))
+                self.stdout.write(row % (
+                    label,
+                    repr(c),
+                    size,
+                    '%.1f' % (encode_time * per_value),
+                    '%.1f' % (decode_time * per_value),
+                ))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_benchmark_intervals
+=====================================================
+
+Simulate fleets of polling tasks under each interval generator.
+"""
+from __future__ import absolute_import
+
+import collections
+import math
+import random
+
+from django.core.management.base import BaseCommand
+
+from modbpm.conf import settings
+from modbpm.core.activity.task import (AdaptiveIntervalGenerator,
+                                       DeadlineIntervalGenerator,
+                                       DefaultIntervalGenerator,
+                                       ExponentialIntervalGenerator,
+                                       StaticIntervalGenerator)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SampledAdaptiveIntervalGenerator(AdaptiveIntervalGenerator):
+    """
+    Adaptive intervals learnt from given completion times rather than
+    from finished activities.
+    """
+
+    def __init__(self, name, times, **kwargs):
+        self.times = times
+        super(SampledAdaptiveIntervalGenerator, self).__init__(name,
+                                                               **kwargs)
+
+    def completion_times(self):
+        return self.times
+
+
+def percentile(values, fraction):
+    return values[int(fraction * (len(values) - 1))]
+
+
+class Command(BaseCommand):
+    help = ("Simulate fleets of polling tasks whose completion times are "
+            "log-normally distributed, and compare the number of polls, "
+            "the delay between completion and the next poll, and the "
+            "peak of polls per second of each interval generator.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=1000,
+                            help="polling tasks per fleet")
+        parser.add_argument('--spread', type=float, default=0,
+                            help="seconds over which tasks are started")
+        parser.add_argument('--median', type=float, default=60,
+                            help="median completion time in seconds")
+        parser.add_argument('--sigma', type=float, default=0.5,
+                            help="sigma of log completion times")
+        parser.add_argument('--static', type=float, default=5,
+                            help="interval of the static generator")
+        parser.add_argument('--deadline', type=float, default=None,
+                            help="deadline of the deadline generator, "
+                                 "defaults to the 90th percentile")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def completion_time(self, options):
+        return random.lognormvariate(math.log(options['median']),
+                                     options['sigma'])
+
+    def generators(self, options):
+        samples = settings.MODBPM_ADAPTIVE_INTERVAL_SAMPLES
+        history = sorted(self.completion_time(options)
+                         for _ in range(samples))
+        deadline = options['deadline'] or percentile(history, 0.9)
+
+        return [
+            ('default', DefaultIntervalGenerator),
+            ('static', lambda: StaticIntervalGenerator(options['static'])),
+            ('exponential', ExponentialIntervalGenerator),
+            ('deadline', lambda: DeadlineIntervalGenerator(deadline)),
+            ('adaptive',
+             lambda: SampledAdaptiveIntervalGenerator('benchmark', history)),
+        ]
+
+    def simulate(self, factory, fleet):
+        clock = self.clock
+        polls = collections.Counter()
+        delays = []
+        total = 0
+
+        for started, duration in fleet:
+            clock.now = started
+            generator = factory()
+
+            finished = started + duration
+            while clock.now < finished:
+                countdown = generator.next()
+                if countdown is None:
+                    break
+                countdown = min(countdown,
+                                settings.MODBPM_MAX_SCHEDULE_INTERVAL)
+                countdown = max(countdown,
+                                settings.MODBPM_MIN_SCHEDULE_INTERVAL)
+                clock.now += countdown
+                polls[int(clock.now)] += 1
+                total += 1
+            delays.append(clock.now - finished)
+
+        delays.sort()
+        return (float(total) / len(fleet),
+                sum(delays) / len(delays),
+                percentile(delays, 0.95),
+                max(polls.values()))
+
+    def handle(self, *args, **options):
+        self.clock = Clock()
+        random.seed(options['seed'])
+        fleet = [(random.uniform(0, options['spread']),
+                  self.completion_time(options))
+                 for _ in range(options['tasks'])]
+
+        row = "%12s %12s %12s %12s %12s"
+        self.stdout.write(row % ('generator', 'polls/task', 'delay(s)',
+                                 'p95 delay(s)', 'peak(/s)'))
+        # generators read the simulated time instead of the wall clock
+        clocks = [(cls, cls.__dict__['clock'])
+                  for cls in (DeadlineIntervalGenerator,
+                              AdaptiveIntervalGenerator)]
+        for cls, _ in clocks:
+            cls.clock = self.clock
+        try:
+            for name, factory in self.generators(options):
+                random.seed(options['seed'])
+                self.stdout.write(row % ((name,) + tuple(
+                    '%.2f' % value if isinstance(value, float) else value
+                    for value in self.simulate(factory, fleet)
+                )))
+        finally:
+            for cls, clock in clocks:
+                cls.clock = clock
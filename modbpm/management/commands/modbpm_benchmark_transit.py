@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_benchmark_transit
+===================================================
+
+Count the queries issued by each type of activity transition.
+"""
+from __future__ import absolute_import
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from django.test.utils import CaptureQueriesContext
+
+from modbpm import states, tasks
+from modbpm.models import ActivityModel
+
+
+class Rollback(Exception):
+    pass
+
+
+TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                       'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+def is_transaction_control(sql):
+    sql = sql.upper()
+    if sql.startswith('QUERY = '):
+        # logged by some backends as "QUERY = u'...' - PARAMS = (...)"
+        sql = sql.split("'", 1)[-1]
+    return sql.startswith(TRANSACTION_CONTROL)
+
+
+def transitions(activity, stale):
+    snapshot = 'x' * 4096
+    return [
+        ('CREATED -> READY, new snapshot',
+         lambda: activity._transit(states.READY, snapshot=snapshot)),
+        ('READY -> RUNNING',
+         lambda: activity._transit(states.RUNNING)),
+        ('RUNNING -> BLOCKED, snapshot delta',
+         lambda: activity._transit(states.BLOCKED,
+                                   snapshot=snapshot[:-1] + 'y')),
+        ('BLOCKED -> READY',
+         lambda: activity._transit(states.READY)),
+        ('READY -> RUNNING',
+         lambda: activity._transit(states.RUNNING)),
+        ('RUNNING -> FINISHED, outputs',
+         lambda: activity.finish(data={'result': 1})),
+        ('stale token',
+         lambda: stale._transit(states.READY)),
+    ]
+
+
+class Command(BaseCommand):
+    help = ("Count the queries issued by each type of activity transition, "
+            "all rows are rolled back afterwards.")
+
+    def handle(self, *args, **options):
+        row = "%-36s %10s %12s"
+        self.stdout.write(row % ('transition', 'statements', 'transaction'))
+
+        # signals of transitions must not publish engine tasks
+        previous = tasks.set_executor(tasks.NullExecutor())
+        try:
+            with transaction.atomic():
+                root = ActivityModel.objects.create_model('benchmark.Root',
+                                                          None)
+                activity = ActivityModel.objects.create_model(
+                    'benchmark.Node', root, 1
+                )
+                activity = ActivityModel.objects.get(pk=activity.pk)
+                stale = ActivityModel.objects.get(pk=activity.pk)
+
+                for name, run in transitions(activity, stale):
+                    with CaptureQueriesContext(connection) as captured:
+                        run()
+                    control = sum(1 for query in captured.captured_queries
+                                  if is_transaction_control(query['sql']))
+                    self.stdout.write(row % (
+                        name, len(captured) - control, control
+                    ))
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            tasks.set_executor(previous)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_collect_blobs
+===============================================
+
+Delete blob store files no longer referenced by any row.
+"""
+from __future__ import absolute_import
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from modbpm import codec
+from modbpm.blobstore import FileBlobStore, KEY_LENGTH
+from modbpm.conf import settings
+from modbpm.models import CompressedBinaryField, CompressedIOField
+
+
+class Command(BaseCommand):
+    help = "Delete blob store files no longer referenced by any row."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help="keep files younger than this many seconds, "
+                                 "they may belong to uncommitted rows")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="report unreferenced files only")
+
+    def get_referenced_keys(self):
+        keys = set()
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for model in apps.get_app_config('modbpm').get_models():
+                for field in model._meta.concrete_fields:
+                    if not isinstance(field, (CompressedIOField,
+                                              CompressedBinaryField)):
+                        continue
+                    # references are a header byte plus the key, read
+                    # them raw to avoid decoding any payload
+                    cursor.execute(
+                        "SELECT %s FROM %s WHERE LENGTH(%s) = %%s" % (
+                            qn(field.column),
+                            qn(model._meta.db_table),
+                            qn(field.column),
+                        ),
+                        [KEY_LENGTH + 1],
+                    )
+                    for value, in cursor.fetchall():
+                        key = codec.external_key(value)
+                        if key:
+                            keys.add(key)
+        return keys
+
+    def handle(self, *args, **options):
+        if not settings.MODBPM_BLOB_STORE_ROOT:
+            raise CommandError("MODBPM_BLOB_STORE_ROOT is not set")
+
+        store = FileBlobStore(settings.MODBPM_BLOB_STORE_ROOT,
+                              settings.MODBPM_BLOB_STORE_THRESHOLD)
+
+        # list candidates before reading references, so that a file
+        # referenced in between is never taken as garbage
+        candidates = list(store.keys(min_age=options['min_age']))
+        referenced = self.get_referenced_keys()
+
+        deleted = 0
+        for key in candidates:
+            if key in referenced:
+                continue
+            if options['dry_run']:
+                deleted += 1
+            elif store.delete(key, min_age=options['min_age']):
+                deleted += 1
+
+        self.stdout.write("%d of %d files unreferenced%s"
+                          % (deleted, len(candidates),
+                             " (dry run)" if options['dry_run'] else ""))
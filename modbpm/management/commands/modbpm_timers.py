@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_timers
+========================================
+
+Poll the timer table and publish due activity transitions.
+"""
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from modbpm import tasks
+from modbpm.conf import settings
+
+
+class Command(BaseCommand):
+    help = "Poll the timer table and publish due activity transitions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            default=settings.MODBPM_TIMER_POLL_INTERVAL,
+                            help="seconds between two polls")
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.MODBPM_TIMER_BATCH_SIZE,
+                            help="due timers fired per transaction")
+        parser.add_argument('--once', action='store_true', default=False,
+                            help="fire due timers once and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            fired = tasks.fire_timers(limit=options['batch_size'])
+            if options['once']:
+                self.stdout.write("fired %d timers" % fired)
+                return
+            if not fired:
+                time.sleep(options['interval'])
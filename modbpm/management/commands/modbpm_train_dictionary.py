@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.management.commands.modbpm_train_dictionary
+==================================================
+
+Train a new preset compression dictionary from stored payloads.
+"""
+from __future__ import absolute_import
+
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from modbpm import codec
+from modbpm.models import (
+    ActivityInputs,
+    ActivityOutputs,
+    CompressionDictionary,
+)
+
+
+class Command(BaseCommand):
+    help = "Train a new preset compression dictionary from stored payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=1000,
+                            help="number of latest rows sampled per table")
+        parser.add_argument('--size', type=int, default=16384,
+                            help="maximum dictionary size in bytes")
+        parser.add_argument('--max-payload', type=int, default=4096,
+                            help="skip payloads larger than this")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="report the result without saving it")
+
+    def get_samples(self, sample, max_payload):
+        serializer = codec.Codec('pickle', 'none')
+
+        querysets = [
+            (ActivityInputs.objects.order_by('-pk')[:sample],
+             ('args', 'kwargs')),
+            (ActivityOutputs.objects.order_by('-pk')[:sample],
+             ('data', 'ex_data')),
+        ]
+        for queryset, fields in querysets:
+            for obj in queryset:
+                for field in fields:
+                    # strip the header byte, dictionaries are trained on
+                    # serialized payloads only
+                    data = serializer.encode(getattr(obj, field))[1:]
+                    if len(data) <= max_payload:
+                        yield data
+
+    def handle(self, *args, **options):
+        samples = list(self.get_samples(options['sample'],
+                                        options['max_payload']))
+        if not samples:
+            raise CommandError("no payloads to sample")
+
+        data = codec.train_dictionary(samples, size=options['size'])
+
+        before = sum(len(zlib.compress(s)) for s in samples)
+        after = sum(len(codec.zdict_compress(s, data)) for s in samples)
+
+        self.stdout.write("samples: %d, dictionary: %d bytes, "
+                          "compressed: %d -> %d bytes"
+                          % (len(samples), len(data), before, after))
+
+        if not options['dry_run']:
+            obj = CompressionDictionary.objects.create(
+                data=data,
+                sample_size=len(samples),
+            )
+            self.stdout.write("saved dictionary version %s" % obj.pk)
@@ -9,32 +9,45 @@ try:
 except ImportError:
     import pickle
 
+import collections
+import contextlib
+import datetime
+import hashlib
 import logging
-import zlib
+import threading
 
-from django.db import models, transaction
-from django.db.models import F
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F, Max, Min, Q
 from django.utils.timezone import now
 
-from modbpm import signals, states, status
-from modbpm.utils import random, unique
+from modbpm import codec, signals, states, status
+from modbpm.blobstore import FileBlobStore
+from modbpm.codec import Codec, Encoded, decode, unwrap
+from modbpm.conf import settings
+from modbpm.utils import delta, random, unique
 
 logger = logging.getLogger(__name__)
 
 
 class CompressedIOField(models.BinaryField):
 
-    def __init__(self, compress_level=6, *args, **kwargs):
+    def __init__(self, compress_level=6, codec=None, *args, **kwargs):
         super(CompressedIOField, self).__init__(*args, **kwargs)
         self.compress_level = compress_level
+        self.codec = codec or Codec('pickle', 'zdict', level=compress_level)
 
     def get_prep_value(self, value):
         value = super(CompressedIOField, self).get_prep_value(value)
-        return zlib.compress(pickle.dumps(value), self.compress_level)
+        if isinstance(value, Encoded):
+            return str(value)
+        return self.codec.encode(value)
 
     def to_python(self, value):
         value = super(CompressedIOField, self).to_python(value)
-        return pickle.loads(zlib.decompress(value))
+        if isinstance(value, Encoded):
+            return value.value
+        return decode(value, legacy_serializer='pickle')
 
     def from_db_value(self, value, expression, connection, context):
         return self.to_python(value)
@@ -42,22 +55,101 @@ class CompressedIOField(models.BinaryField):
 
 class CompressedBinaryField(models.BinaryField):
 
-    def __init__(self, compress_level=6, *args, **kwargs):
+    def __init__(self, compress_level=6, codec=None, *args, **kwargs):
         super(CompressedBinaryField, self).__init__(*args, **kwargs)
         self.compress_level = compress_level
+        self.codec = codec or Codec('bytes', 'zlib', level=compress_level)
 
     def get_prep_value(self, value):
         value = super(CompressedBinaryField, self).get_prep_value(value)
-        return zlib.compress(value, self.compress_level)
+        if isinstance(value, Encoded):
+            return str(value)
+        return self.codec.encode(value)
 
     def to_python(self, value):
         value = super(CompressedBinaryField, self).to_python(value)
-        return zlib.decompress(value)
+        if isinstance(value, Encoded):
+            return value.value
+        return decode(value, legacy_serializer='bytes')
 
     def from_db_value(self, value, expression, connection, context):
         return self.to_python(value)
 
 
+def payload_checksum(**fields):
+    """
+    Compute a content checksum of the given payload fields.
+    """
+    sha = hashlib.sha256()
+    for name in sorted(fields):
+        sha.update(pickle.dumps((name, unwrap(fields[name])),
+                                pickle.HIGHEST_PROTOCOL))
+    return sha.hexdigest()
+
+
+def _chunked(items, size=500):
+    """
+    Split ``items`` into lists of at most ``size`` items, to keep ``IN``
+    lookups within the parameter limits of all database backends.
+    """
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PayloadModelManager(models.Manager):
+
+    def get_or_create_payload(self, **fields):
+        """
+        Get the payload object with identical content, create one if
+        there is none, so that identical payloads share a single row.
+        """
+        checksum = payload_checksum(**fields)
+        obj, created = self.get_or_create(checksum=checksum,
+                                          defaults=fields)
+        if created:
+            for name, value in fields.iteritems():
+                setattr(obj, name, unwrap(value))
+        return obj
+
+    def _in_bulk_by_checksum(self, checksums):
+        objs = {}
+        for chunk in _chunked(checksums):
+            # payload columns are deferred, only keys are needed here
+            for obj in self.filter(checksum__in=chunk).only('checksum'):
+                objs[obj.checksum] = obj
+        return objs
+
+    def get_or_create_payloads(self, payloads):
+        """
+        Bulk version of :meth:`get_or_create_payload`, ``payloads`` is a
+        list of field dicts, the payload objects are returned in the same
+        order, with their payload columns deferred.
+        """
+        checksums = [payload_checksum(**fields) for fields in payloads]
+        objs = self._in_bulk_by_checksum(set(checksums))
+
+        missing = {}
+        for checksum, fields in zip(checksums, payloads):
+            if checksum not in objs:
+                missing[checksum] = fields
+
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create([
+                        self.model(checksum=checksum, **fields)
+                        for checksum, fields in missing.iteritems()
+                    ])
+            except IntegrityError:
+                # some of them were created concurrently
+                for fields in missing.itervalues():
+                    self.get_or_create_payload(**fields)
+            objs.update(self._in_bulk_by_checksum(missing))
+
+        return [objs[checksum] for checksum in checksums]
+
+
 class ActivityInputs(models.Model):
 
     args = CompressedIOField(
@@ -74,6 +166,8 @@ class ActivityInputs(models.Model):
         blank=True,
     )
 
+    objects = PayloadModelManager()
+
     def __unicode__(self):
         return unicode(u"#%s" % self.pk)
 
@@ -94,12 +188,97 @@ class ActivityOutputs(models.Model):
         blank=True,
     )
 
+    objects = PayloadModelManager()
+
     def __unicode__(self):
         return unicode(u"#%s" % self.pk)
 
 
 class ActivitySnapshot(models.Model):
+    """
+    Snapshot of an activity, stored as a base version in :attr:`data` plus
+    a chain of binary deltas, see :meth:`save_content`.
+    """
+
+    data = CompressedBinaryField(
+        blank=True,
+    )
+
+    checksum = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+    )
+    delta_count = models.PositiveSmallIntegerField(
+        default=0,
+    )
+
+    def __unicode__(self):
+        return unicode(u"#%s" % self.pk)
+
+    @property
+    def content(self):
+        """
+        Latest version of this snapshot, the base with all deltas applied.
+        """
+        if not hasattr(self, '_content'):
+            content = self.data
+            if self.delta_count:
+                for obj in self.deltas.order_by('pk'):
+                    content = delta.patch(content, obj.data)
+            self._content = content
+        return self._content
+
+    def save_content(self, snapshot):
+        """
+        Store ``snapshot`` as the latest version of this snapshot.
 
+        Nothing is written if it is unchanged, otherwise only a delta is
+        appended, unless the previous version is unknown, the delta is not
+        worth it or the chain is too long, then the base is rewritten.
+        """
+        content = unwrap(snapshot)
+        checksum = hashlib.sha1(content).hexdigest()
+        if checksum == self.checksum:
+            return False
+
+        changes = None
+        if hasattr(self, '_content') and \
+                self.delta_count < settings.MODBPM_SNAPSHOT_MAX_DELTAS:
+            changes = delta.diff(self._content, content)
+            if len(changes) * 2 > len(content):
+                changes = None
+
+        if changes is None:
+            if self.delta_count:
+                self.deltas.all().delete()
+            # not through self.__class__, which is a deferred subclass
+            # when loaded with only(), updates of those select pks first
+            ActivitySnapshot.objects.filter(pk=self.pk) \
+                                    .update(data=snapshot,
+                                            checksum=checksum,
+                                            delta_count=0)
+            self.data = content
+            self.delta_count = 0
+        else:
+            ActivitySnapshotDelta.objects.create(snapshot=self,
+                                                 data=changes)
+            ActivitySnapshot.objects.filter(pk=self.pk) \
+                                    .update(checksum=checksum,
+                                            delta_count=F('delta_count') + 1)
+            self.delta_count += 1
+
+        self.checksum = checksum
+        self._content = content
+        return True
+
+
+class ActivitySnapshotDelta(models.Model):
+
+    snapshot = models.ForeignKey(
+        ActivitySnapshot,
+        related_name='deltas',
+    )
     data = CompressedBinaryField(
         blank=True,
     )
@@ -108,8 +287,383 @@ class ActivitySnapshot(models.Model):
         return unicode(u"#%s" % self.pk)
 
 
+def _delete_snapshots(snapshot_ids, using):
+    """
+    Delete snapshots and their deltas without collecting related objects
+    first, callers make sure nothing refers to them anymore.
+    """
+    for chunk in _chunked(snapshot_ids):
+        ActivitySnapshotDelta.objects.filter(snapshot__in=chunk) \
+                                     ._raw_delete(using)
+        ActivitySnapshot.objects.filter(pk__in=chunk)._raw_delete(using)
+
+
+class CompressionDictionaryManager(models.Manager):
+
+    def load(self, version=None):
+        """
+        Load ``(version, data)`` of the given or the latest dictionary.
+        """
+        queryset = self.order_by('-pk')
+        if version is not None:
+            queryset = queryset.filter(pk=version)
+
+        for obj in queryset.only('pk', 'data')[:1]:
+            return obj.pk, bytes(obj.data)
+
+
+class CompressionDictionary(models.Model):
+    """
+    Versioned preset dictionaries of the ``zdict`` compressor, the primary
+    key is the version recorded in every value compressed with it.
+    """
+
+    data = models.BinaryField()
+    sample_size = models.PositiveIntegerField(
+        default=0,
+    )
+
+    date_created = models.DateTimeField(auto_now_add=True, blank=True)
+
+    objects = CompressionDictionaryManager()
+
+    def __unicode__(self):
+        return unicode(u"v%s" % self.pk)
+
+
+codec.set_dictionary_loader(
+    CompressionDictionary.objects.load,
+    ttl=settings.MODBPM_COMPRESSION_DICTIONARY_TTL,
+)
+
+if settings.MODBPM_BLOB_STORE_ROOT:
+    codec.set_blob_store(FileBlobStore(
+        settings.MODBPM_BLOB_STORE_ROOT,
+        settings.MODBPM_BLOB_STORE_THRESHOLD,
+    ))
+
+
+class ActivityPayloadMixin(object):
+    """
+    Read access to the inputs and outputs of an activity, subclasses get
+    the payload objects through ``_payload('inputs' or 'outputs')``.
+    """
+
+    @property
+    def args(self):
+        inputs = self._payload('inputs')
+        if inputs is not None:
+            return inputs.args
+        else:
+            return list()
+
+    @property
+    def kwargs(self):
+        inputs = self._payload('inputs')
+        if inputs is not None:
+            return inputs.kwargs
+        else:
+            return dict()
+
+    @property
+    def data(self):
+        outputs = self._payload('outputs')
+        if outputs is not None:
+            return outputs.data
+
+    @property
+    def ex_data(self):
+        outputs = self._payload('outputs')
+        if outputs is not None:
+            return outputs.ex_data
+
+
+class IdentityMap(object):
+    """
+    Activities loaded within a unit of work, so that repeated lookups of
+    the same row return the same instance, see
+    :meth:`ActivityModelManager.identity_scope`.
+    """
+
+    def __init__(self):
+        self.by_pk = {}
+        self.by_code = {}
+
+    def add(self, instance):
+        self.forget(instance.pk)
+        self.by_pk[instance.pk] = instance
+        if instance.token_code is not None:
+            self.by_code[instance.identifier_code] = instance
+        return instance
+
+    def forget(self, *pks):
+        for pk in pks:
+            instance = self.by_pk.pop(pk, None)
+            if instance is not None \
+                    and self.by_code.get(instance.identifier_code) \
+                    is instance:
+                del self.by_code[instance.identifier_code]
+
+    def find(self, kwargs):
+        """
+        Get the loaded activity matching the exact or ``isnull`` lookups of
+        ``kwargs``, or None if it has to be read from database.
+        """
+        if 'pk' in kwargs:
+            instance = self.by_pk.get(kwargs['pk'])
+        else:
+            instance = self.by_code.get(kwargs.get('identifier_code'))
+        if instance is None:
+            return None
+
+        deferred = instance.get_deferred_fields()
+        for lookup, value in kwargs.iteritems():
+            name, _, op = lookup.partition('__')
+            if name in deferred or op not in ('', 'isnull'):
+                return None
+            actual = instance.pk if name == 'pk' else getattr(instance, name)
+            if op == 'isnull':
+                actual, value = actual is None, bool(value)
+            if actual != value:
+                return None
+        return instance
+
+
+_local = threading.local()
+
+
 class ActivityModelManager(models.Manager):
 
+    # columns needed to tell the state of an activity and to read its
+    # payloads later on, see probe()
+    PROBE_FIELDS = ('name', 'identifier_code', 'token_code', 'state',
+                    'appointment', 'parent', 'root', 'outputs',
+                    'children_created', 'children_archived',
+                    'children_finished', 'children_failed')
+
+    def probe(self, **kwargs):
+        """
+        Get an activity with the state columns only, payloads are loaded
+        on access or in batch with :meth:`load_payloads`.
+        """
+        return self._identity_get(self.PROBE_FIELDS, kwargs)
+
+    def lookup(self, **kwargs):
+        """
+        Same as ``get``, but the identity map of the current unit of work
+        is used, if any.
+        """
+        return self._identity_get(None, kwargs)
+
+    def _identity_get(self, fields, kwargs):
+        identities = getattr(_local, 'identities', None)
+        if identities is not None:
+            instance = identities.find(kwargs)
+            if instance is not None \
+                    and (fields or not instance.get_deferred_fields()):
+                return instance
+
+        queryset = self.only(*fields) if fields else self.all()
+        instance = queryset.get(**kwargs)
+        if identities is not None:
+            identities.add(instance)
+        return instance
+
+    @contextlib.contextmanager
+    def identity_scope(self):
+        """
+        Unit of work in which activities are read once, and then returned
+        from an identity map until they are written again.
+        """
+        previous = getattr(_local, 'identities', None)
+        _local.identities = IdentityMap()
+        try:
+            yield _local.identities
+        finally:
+            _local.identities = previous
+
+    def forget(self, *pks):
+        """
+        Drop activities from the identity map, they are read again from
+        database on their next lookup.
+        """
+        identities = getattr(_local, 'identities', None)
+        if identities is not None:
+            identities.forget(*pks)
+
+    def forget_all(self):
+        identities = getattr(_local, 'identities', None)
+        if identities is not None:
+            identities.forget(*identities.by_pk.keys())
+
+    def remember(self, instance):
+        """
+        Make ``instance``, which has just been written, the one returned by
+        lookups of its row in the current unit of work.
+        """
+        identities = getattr(_local, 'identities', None)
+        if identities is not None:
+            identities.add(instance)
+
+    def load_payloads(self, instances, *fields):
+        """
+        Load payloads (``inputs``, ``outputs`` and ``snapshot`` by default)
+        of the given activities, with one query per payload table.
+        """
+        fields = fields or ('inputs', 'outputs', 'snapshot')
+        for name in fields:
+            field = self.model._meta.get_field(name)
+            pks = set(getattr(obj, field.attname) for obj in instances)
+            pks.discard(None)
+            payloads = field.rel.to.objects.in_bulk(pks) if pks else {}
+            for obj in instances:
+                setattr(obj, field.get_cache_name(),
+                        payloads.get(getattr(obj, field.attname)))
+        return instances
+
+    def load_snapshots(self, instances):
+        """
+        Load the snapshots of the given activities along with their deltas,
+        with one query per table rather than per activity.
+        """
+        self.load_payloads(instances, 'snapshot')
+        snapshots = [obj.snapshot for obj in instances
+                     if obj.snapshot_id is not None and obj.snapshot]
+
+        chains = collections.defaultdict(list)
+        for chunk in _chunked([s.pk for s in snapshots if s.delta_count]):
+            for obj in ActivitySnapshotDelta.objects.filter(
+                    snapshot__in=chunk).order_by('pk'):
+                chains[obj.snapshot_id].append(obj.data)
+
+        for snapshot in snapshots:
+            content = snapshot.data
+            for changes in chains.get(snapshot.pk, ()):
+                content = delta.patch(content, changes)
+            snapshot._content = content
+        return instances
+
+    def claim(self, pks):
+        """
+        Make the blocked activities of ``pks`` ready all at once, without
+        signals, so that the caller schedules them itself. Activities with
+        an appointment are left out. Returns the ready activities of
+        ``pks`` with their snapshots loaded.
+        """
+        self._update_in_chunks(
+            self.filter(pk__in=pks, state=states.BLOCKED, appointment=''),
+            state=states.READY,
+        )
+        instances = []
+        for chunk in _chunked(pks):
+            instances.extend(self.filter(pk__in=chunk, state=states.READY))
+        for instance in instances:
+            self.remember(instance)
+        return self.load_snapshots(instances)
+
+    def transit_claimed(self, instances, to_state, snapshots=None):
+        """
+        Transit activities returned by :meth:`claim` to ``to_state`` with
+        one update per chunk rather than one per activity, without signals.
+        ``snapshots`` maps activity ids to the snapshots to write along.
+
+        Activities with an appointment, or changed by somebody else since,
+        are left out for single transitions. Returns the transited ones.
+        """
+        transited = []
+        instances = [obj for obj in instances
+                     if states.can_transit(obj.state, to_state)]
+        for chunk in _chunked(instances):
+            by_pk = dict((obj.pk, obj) for obj in chunk)
+            token_code = random.randstr()
+            with transaction.atomic():
+                self.filter(
+                    pk__in=by_pk.keys(),
+                    token_code__in=set(obj.token_code for obj in chunk),
+                    appointment='',
+                ).update(state=to_state, token_code=token_code)
+
+                for pk in self.filter(pk__in=by_pk.keys(),
+                                      token_code=token_code) \
+                              .values_list('pk', flat=True):
+                    obj = by_pk[pk]
+                    obj.state = to_state
+                    obj.token_code = token_code
+                    if snapshots is not None:
+                        obj._write_snapshot(snapshots[pk])
+                    self.remember(obj)
+                    transited.append(obj)
+
+        logger.info("transit %d activities to %r" % (len(transited), to_state))
+        return transited
+
+    def _count_children(self, parent_id, **deltas):
+        """
+        Add ``deltas`` to the child counters of ``parent_id``, e.g.
+        ``_count_children(pk, created=1)``.
+        """
+        self.filter(pk=parent_id).update(**dict(
+            ('children_' + k, F('children_' + k) + v)
+            for k, v in deltas.iteritems()
+        ))
+        self.forget(parent_id)
+
+    def _child_counters(self, state):
+        """
+        Get the deltas of the child counters of its parent for one live
+        child in ``state``.
+        """
+        counters = {'created': 1}
+        if state in states.ARCHIVED_STATES:
+            counters['archived'] = 1
+        if state == states.FINISHED:
+            counters['finished'] = 1
+        elif state == states.FAILED:
+            counters['failed'] = 1
+        return counters
+
+    def backfill_counters(self, chunk_size=None):
+        """
+        Count the live children of parents written before the child
+        counters existed, i.e. those with children but none counted,
+        ``chunk_size`` parents per transaction. Returns the number of
+        parents counted.
+        """
+        chunk_size = chunk_size or settings.MODBPM_SUBTREE_CHUNK_SIZE
+        parents = self.filter(
+            children_created=0,
+            pk__in=self.filter(token_code__isnull=False,
+                               parent__isnull=False).values('parent_id'),
+        ).order_by('pk')
+
+        count = 0
+        last = 0
+        while True:
+            with transaction.atomic():
+                pks = list(parents.filter(pk__gt=last)
+                                  .values_list('pk', flat=True)[:chunk_size])
+                if not pks:
+                    break
+
+                counters = collections.defaultdict(collections.Counter)
+                for parent_id, state, n in self.filter(
+                        parent__in=pks,
+                        token_code__isnull=False,
+                ).order_by().values_list('parent_id', 'state') \
+                        .annotate(n=models.Count('pk')):
+                    for k, v in self._child_counters(state).iteritems():
+                        counters[parent_id][k] += v * n
+
+                for parent_id, deltas in counters.iteritems():
+                    self.filter(pk=parent_id, children_created=0).update(
+                        **dict(('children_' + k, v)
+                               for k, v in deltas.iteritems()))
+                self.forget(*pks)
+
+            count += len(counters)
+            last = pks[-1]
+        return count
+
     @transaction.atomic
     def _supersede(self, instance, *args, **kwargs):
         assert isinstance(instance, self.model)
@@ -123,8 +677,14 @@ class ActivityModelManager(models.Manager):
 
             self.model.objects.filter(pk=instance.pk) \
                               .update(token_code=None)
+            self.forget(instance.pk)
+            # the failed activity is replaced and no longer counted.
+            if instance.parent_id is not None:
+                self._count_children(instance.parent_id,
+                                     archived=-1, failed=-1)
             activity = self.model(name=instance.name,
                                   parent=instance.parent,
+                                  root_id=instance.root_id,
                                   args=args,
                                   kwargs=kwargs,
                                   identifier_code=identifier_code,
@@ -138,31 +698,33 @@ class ActivityModelManager(models.Manager):
             'name': _name,
         }
 
-        # create inputs object if necessary.
+        # reuse or create inputs object if necessary.
         if args or kwargs:
-            params['inputs'] = ActivityInputs.objects.create(
+            params['inputs'] = ActivityInputs.objects.get_or_create_payload(
                 args=args,
                 kwargs=kwargs,
             )
 
+        # denormalize parent and root of the activity tree.
+        if isinstance(_parent, self.model):
+            params['parent'] = _parent
+            params['root_id'] = _parent.root_id or _parent.pk
+
         # create model object of the target activity.
         activity = self.model.objects.create(**params)
 
-        # build relationships with ancestors.
+        # a root activity is the root of its own tree.
+        if activity.root_id is None:
+            self.model.objects.filter(pk=activity.pk) \
+                              .update(root=activity.pk)
+            activity.root_id = activity.pk
+
+        # build relationships with ancestors and count the new child.
         if isinstance(_parent, self.model):
-            rels = [ActivityRelationship(
-                ancestor=_parent,
-                descendant=activity,
-                distance=1,
-            )]
-            for rel in _parent.ancestor_set.all():
-                rels.append(ActivityRelationship(
-                    ancestor=rel.ancestor,
-                    descendant=activity,
-                    distance=(rel.distance + 1),
-                ))
             with transaction.atomic():
-                ActivityRelationship.objects.bulk_create(rels)
+                ActivityRelationship.objects.attach(_parent.pk,
+                                                    [activity.pk])
+                self._count_children(_parent.pk, created=1)
 
         # signals must be sent outside transactions to prevent
         # phantom reads and transaction deadlocks
@@ -171,13 +733,228 @@ class ActivityModelManager(models.Manager):
 
         return activity
 
+    def create_models(self, _parent, specs):
+        """
+        Create many activities at once, ``specs`` is a list of
+        ``(name, args, kwargs)`` tuples.
+
+        All rows are written with a few bulk statements in a single
+        transaction, then one ``activities_created`` signal is sent.
+        """
+        specs = list(specs)
+        if not specs:
+            return []
+
+        with transaction.atomic():
+            # reuse or create inputs objects if necessary.
+            payloads = [dict(args=args, kwargs=kwargs)
+                        for _, args, kwargs in specs if args or kwargs]
+            inputs = iter(ActivityInputs.objects.get_or_create_payloads(
+                payloads
+            ))
+
+            activities = []
+            for name, args, kwargs in specs:
+                activity = self.model(name=name)
+                if args or kwargs:
+                    activity.inputs = next(inputs)
+                if isinstance(_parent, self.model):
+                    activity.parent = _parent
+                    activity.root_id = _parent.root_id or _parent.pk
+                activities.append(activity)
+
+            self.bulk_create(activities)
+
+            # primary keys are not returned by bulk inserts on every
+            # backend, look them up by the unique identifier codes.
+            pks = {}
+            for chunk in _chunked(a.identifier_code for a in activities):
+                pks.update(self.filter(identifier_code__in=chunk)
+                               .values_list('identifier_code', 'pk'))
+            for activity in activities:
+                activity.pk = pks[activity.identifier_code]
+
+            if isinstance(_parent, self.model):
+                # build relationships with ancestors.
+                ActivityRelationship.objects.attach(
+                    _parent.pk,
+                    [activity.pk for activity in activities],
+                )
+                self._count_children(_parent.pk, created=len(activities))
+            else:
+                # root activities are the roots of their own trees.
+                for chunk in _chunked(a.pk for a in activities):
+                    self.filter(pk__in=chunk).update(root=F('pk'))
+                for activity in activities:
+                    activity.root_id = activity.pk
+
+        # signals must be sent outside transactions to prevent
+        # phantom reads and transaction deadlocks
+        signals.activities_created.send(sender=self.model,
+                                        instances=activities)
+
+        return activities
+
+    def completion_times(self, name, limit):
+        """
+        Seconds taken by the last ``limit`` finished activities of
+        ``name``, sorted.
+        """
+        rows = self.filter(
+            name=name,
+            state=states.FINISHED,
+        ).order_by('-pk').values_list('date_created', 'date_archived')
+        return sorted((archived - created).total_seconds()
+                      for created, archived in rows[:limit]
+                      if archived is not None)
+
+    def _subtree(self, ancestor_id):
+        descendants = ActivityRelationship.objects.filter(
+            ancestor=ancestor_id
+        ).values('descendant')
+        return self.filter(Q(pk=ancestor_id) | Q(pk__in=descendants),
+                           token_code__isnull=False)
+
+    def _update_in_chunks(self, queryset, signal=None, **kwargs):
+        """
+        Update the activities of ``queryset`` with ``kwargs`` chunk by chunk,
+        each chunk in a transaction of its own, then send ``signal`` with
+        the updated activities of the chunk. ``queryset`` must not match
+        updated activities anymore. Returns the number of updated rows.
+
+        If ``kwargs`` has a state, activities get a fresh token code, so
+        that pending ``transit`` messages published with the former token
+        can not transit them anymore. Timers of suspended and archived
+        activities are deleted.
+        """
+        to_state = kwargs.get('state')
+        archived = to_state in states.ARCHIVED_STATES
+        if archived:
+            kwargs.update(snapshot=None, date_archived=now())
+
+        count = 0
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.select_for_update().values_list(
+                    'pk', 'parent_id', 'snapshot_id'
+                )[:settings.MODBPM_SUBTREE_CHUNK_SIZE])
+                if not rows:
+                    return count
+
+                pks = [pk for pk, _, _ in rows]
+                if to_state:
+                    # one token per chunk is unique enough, only one live
+                    # activity exists per identifier code
+                    kwargs['token_code'] = random.randstr()
+                self.filter(pk__in=pks).update(**kwargs)
+                self.forget(*pks)
+
+                if archived or to_state == states.SUSPENDED:
+                    # pending timers would only wake them up for nothing,
+                    # resumed activities are scheduled again anyway
+                    ActivityTimer.objects.filter(activity_id__in=pks) \
+                                         ._raw_delete(self.db)
+                if archived:
+                    _delete_snapshots([sid for _, _, sid in rows
+                                       if sid is not None], self.db)
+                    parents = collections.Counter(
+                        parent_id for _, parent_id, _ in rows
+                        if parent_id is not None
+                    )
+                    for parent_id, n in parents.iteritems():
+                        counters = {'archived': n}
+                        if to_state == states.FAILED:
+                            counters['failed'] = n
+                        self._count_children(parent_id, **counters)
+
+            count += len(pks)
+            logger.info("update %d activities with %r" % (len(pks), kwargs))
+
+            # signals must be sent outside transactions to prevent
+            # phantom reads and transaction deadlocks
+            if signal is not None:
+                signal.send(sender=self.model,
+                            instances=list(self.only(*self.PROBE_FIELDS)
+                                               .filter(pk__in=pks)))
+
+    def _appoint_subtree(self, ancestor_id, to_state):
+        """
+        Move the subtree of ``ancestor_id`` to ``to_state`` wherever it is
+        possible right now, and appoint it to the other live activities.
+        """
+        subtree = self._subtree(ancestor_id)
+        direct = [s for s in states.ALL_STATES
+                  if states.can_transit(s, to_state)]
+        signal = getattr(signals, 'activities_' + to_state.lower())
+
+        appointed = self._update_in_chunks(
+            subtree.exclude(state__in=states.ARCHIVED_STATES)
+                   .exclude(state__in=direct)
+                   .exclude(appointment__in=[to_state, states.REVOKED]),
+            appointment=to_state,
+        )
+        moved = self._update_in_chunks(
+            subtree.filter(state__in=direct),
+            signal=signal,
+            state=to_state,
+            appointment='',
+        )
+        return moved + appointed
+
+    def suspend_subtree(self, ancestor_id):
+        """
+        Suspend an activity and its descendants.
+        """
+        return self._appoint_subtree(ancestor_id, states.SUSPENDED)
+
+    def revoke_subtree(self, ancestor_id):
+        """
+        Revoke an activity and its descendants.
+        """
+        return self._appoint_subtree(ancestor_id, states.REVOKED)
+
+    def resume_subtree(self, ancestor_id):
+        """
+        Clear suspensions of an activity and its descendants, and make the
+        suspended ones ready again.
+        """
+        subtree = self._subtree(ancestor_id)
+        cleared = self._update_in_chunks(
+            subtree.filter(appointment=states.SUSPENDED)
+                   .exclude(state=states.SUSPENDED),
+            appointment='',
+        )
+        resumed = self._update_in_chunks(
+            subtree.filter(state=states.SUSPENDED),
+            signal=signals.activities_ready,
+            state=states.READY,
+            appointment='',
+        )
+        return cleared + resumed
+
+    def get_any(self, **kwargs):
+        """
+        Get an activity from the hot table, or from the archive if its
+        tree has been archived.
+        """
+        try:
+            return self.get(**kwargs)
+        except self.model.DoesNotExist:
+            try:
+                return ArchivedActivityModel.objects.get(**kwargs)
+            except ArchivedActivityModel.DoesNotExist:
+                raise self.model.DoesNotExist(
+                    "%s matching query does not exist in any tier."
+                    % self.model._meta.object_name
+                )
+
     def retry_activity(self, instance, *args, **kwargs):
         if instance.state == states.FAILED:
             return self._supersede(instance, *args, **kwargs)
         return False
 
 
-class ActivityModel(models.Model):
+class ActivityModel(ActivityPayloadMixin, models.Model):
 
     name = models.CharField(
         max_length=100,
@@ -192,16 +969,33 @@ class ActivityModel(models.Model):
         default=random.randstr,
     )
 
-    # inputs and outputs
+    # denormalized activity tree, see also ActivityRelationship
+    parent = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        related_name='children',
+    )
+    root = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        related_name='+',
+    )
+
+    # inputs and outputs, not constrained since shared payloads may be
+    # moved to the archive together with another activity tree.
     inputs = models.ForeignKey(
         ActivityInputs,
         null=True,
         blank=True,
+        db_constraint=False,
     )
     outputs = models.ForeignKey(
         ActivityOutputs,
         null=True,
         blank=True,
+        db_constraint=False,
     )
 
     # states and transitions
@@ -226,6 +1020,16 @@ class ActivityModel(models.Model):
         default=0,
     )
 
+    # counters of child activities, kept up to date along with their
+    # creations and transitions, so that the progress of all children
+    # can be read from the row of their parent.
+    children_created = models.PositiveIntegerField(default=0)
+    children_archived = models.PositiveIntegerField(default=0)
+    children_finished = models.PositiveIntegerField(default=0)
+    children_failed = models.PositiveIntegerField(default=0)
+    # children finished while this activity was running, see _defer_ack()
+    pending_acks = models.PositiveIntegerField(default=0)
+
     # important datetimes
     date_created = models.DateTimeField(auto_now_add=True, blank=True)
     date_archived = models.DateTimeField(blank=True, null=True)
@@ -242,6 +1046,8 @@ class ActivityModel(models.Model):
 
     class Meta:
         unique_together = ('identifier_code', 'token_code')
+        # running activities of a class are counted by ActivityThrottle
+        index_together = ('name', 'state')
 
     def __unicode__(self):
         return unicode(u"[#%d] %s" % (
@@ -258,6 +1064,38 @@ class ActivityModel(models.Model):
     def _acknowledge(self):
         self.__class__.objects.filter(pk=self.pk) \
                               .update(acknowledgment=F('acknowledgment') + 1)
+        self.__class__.objects.forget(self.pk)
+
+    def _defer_ack(self):
+        """
+        Record that a child finished while this activity is running, it is
+        woken up once for all of them by :meth:`_drain_acks`. Returns False
+        if this activity is not running anymore.
+        """
+        rows = self.__class__.objects.filter(
+            pk=self.pk,
+            state=states.RUNNING,
+        ).update(pending_acks=F('pending_acks') + 1)
+        self.__class__.objects.forget(self.pk)
+        return bool(rows)
+
+    def _drain_acks(self):
+        """
+        Acknowledge the children recorded by :meth:`_defer_ack` in one
+        pass, returns True if there were any.
+        """
+        rows = self.__class__.objects.filter(
+            pk=self.pk,
+            pending_acks__gt=0,
+        ).update(pending_acks=0)
+        if rows:
+            self.__class__.objects.filter(
+                parent=self.pk,
+                acknowledgment=0,
+                state__in=states.ARCHIVED_STATES,
+            ).update(acknowledgment=F('acknowledgment') + 1)
+        self.__class__.objects.forget(self.pk)
+        return bool(rows)
 
     @transaction.atomic
     def _appoint(self, to_state):
@@ -282,8 +1120,12 @@ class ActivityModel(models.Model):
             self.descendants.exclude(token_code__isnull=True,
                                      state__in=states.ARCHIVED_STATES) \
                             .update(appointment=to_state)
+            # descendants have been written as well
+            self.__class__.objects.forget_all()
+            self.__class__.objects.remember(self)
             return True
 
+        self.__class__.objects.forget(self.pk)
         return False
 
     def _transit(self, to_state, **kwargs):
@@ -300,168 +1142,188 @@ class ActivityModel(models.Model):
                 to_state = self.appointment
                 appointment_flag = 2  # 设置为预约状态
 
-        if states.can_transit(self.state, to_state) and self.token_code:
-            kwargs.update({
-                'token_code': random.randstr(),
-                'state': to_state,
-            })
-
-            if appointment_flag:  # 一旦处理了预约，就将其置空
-                kwargs['appointment'] = ''
-
-            original_state = self.state
+        if not (states.can_transit(self.state, to_state) and self.token_code):
+            logger.info("transit activity #%s failed." % self.pk)
+            return False
+
+        kwargs.update({
+            'token_code': random.randstr(),
+            'state': to_state,
+        })
+
+        if appointment_flag:  # 一旦处理了预约，就将其置空
+            kwargs['appointment'] = ''
+
+        logger.info("transit activity #%s from %r to %r"
+                    % (self.pk, self.state, to_state))
+
+        # the guarded update is a statement of its own, a transaction is
+        # only needed if other rows are written along with it.
+        if to_state in states.ARCHIVED_STATES:
+            side_writes = kwargs.get('data') is not None \
+                or kwargs.get('ex_data') is not None \
+                or self.snapshot_id is not None \
+                or self.parent_id is not None
+        else:
+            side_writes = isinstance(kwargs.get('snapshot'), basestring)
 
+        if side_writes:
             with transaction.atomic():
-                sid = transaction.savepoint()
-
-                if to_state in states.ARCHIVED_STATES:
-                    # prepare outputs model if necessary
-                    data = kwargs.pop('data', None)
-                    ex_data = kwargs.pop('ex_data', None)
-                    if not (data is None and ex_data is None):
-                        kwargs['outputs'] = ActivityOutputs.objects.create(
-                            data=data,
-                            ex_data=ex_data,
-                        )
-
-                    # clear snapshot model foreign key
-                    if isinstance(self.snapshot, ActivitySnapshot):
-                        kwargs['snapshot'] = None
-                        _snapshot_id = self.snapshot_id
-
-                    # set date_archived value to now
-                    kwargs['date_archived'] = now()
-                elif isinstance(kwargs.get('snapshot'), basestring):
-                    snapshot, created = self._update_or_create_snapshot(
-                        kwargs['snapshot']
-                    )
-                    if created:
-                        kwargs['snapshot'] = snapshot
-                    else:
-                        del kwargs['snapshot']
-
-                logger.info("transit activity #%s from %r to %r"
-                            % (self.pk, self.state, to_state))
-
-                rows = self.__class__.objects.filter(
-                    pk=self.pk,
-                    token_code=self.token_code
-                ).update(**kwargs)
-
-                if rows:
-                    _snapshot_id = locals().get('_snapshot_id')
-                    if isinstance(_snapshot_id, (int, long)):
-                        ActivitySnapshot.objects.filter(pk=_snapshot_id) \
-                                                .delete()
-                    transaction.savepoint_commit(sid)
-
-                    for k, v in kwargs.iteritems():
-                        setattr(self, k, v)
-                else:
-                    transaction.savepoint_rollback(sid)
-
-        if self.state == original_state:
-            logger.info("transit activity #%s failed." % self.pk)
+                rows = self._write_transition(to_state, kwargs)
+                if not rows:
+                    # discard the rows written for this transition
+                    transaction.set_rollback(True)
         else:
-            # state change signal
-            sc_signal = getattr(signals,
-                                'activity_' + to_state.lower(),
-                                None)
-
-            if sc_signal:
-                logger.info("send signal %r for activity #%s"
-                            % (to_state, self.pk))
-                # TODO: signals must be sent outside transactions to
-                # prevent phantom reads and transaction deadlocks
-                sc_signal.send(sender=self.__class__,
-                               instance=self)
-
-            if appointment_flag != 2:
-                logger.info("transit activity #%s success." % self.pk)
-                return True
+            rows = self._write_transition(to_state, kwargs)
+
+        if not rows:
+            # the row was changed by somebody else
+            self.__class__.objects.forget(self.pk)
+            logger.info("transit activity #%s failed." % self.pk)
+            return False
+
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+        self.__class__.objects.remember(self)
+
+        # state change signal
+        sc_signal = getattr(signals,
+                            'activity_' + to_state.lower(),
+                            None)
+
+        if sc_signal:
+            logger.info("send signal %r for activity #%s"
+                        % (to_state, self.pk))
+            # TODO: signals must be sent outside transactions to
+            # prevent phantom reads and transaction deadlocks
+            sc_signal.send(sender=self.__class__,
+                           instance=self)
+
+        if appointment_flag != 2:
+            logger.info("transit activity #%s success." % self.pk)
+            return True
 
         return False
 
+    def _write_transition(self, to_state, kwargs):
+        """
+        Write the transition described by ``kwargs``, guarded by the
+        current token code, returns the number of updated rows.
+        """
+        snapshot_id = None
+        if to_state in states.ARCHIVED_STATES:
+            # reuse or create outputs model if necessary
+            data = kwargs.pop('data', None)
+            ex_data = kwargs.pop('ex_data', None)
+            if not (data is None and ex_data is None):
+                kwargs['outputs'] = \
+                    ActivityOutputs.objects.get_or_create_payload(
+                        data=data,
+                        ex_data=ex_data,
+                    )
+
+            # clear snapshot model foreign key
+            if self.snapshot_id is not None:
+                kwargs['snapshot'] = None
+                snapshot_id = self.snapshot_id
+
+            # set date_archived value to now
+            kwargs['date_archived'] = now()
+        elif isinstance(kwargs.get('snapshot'), basestring):
+            snapshot, created = self._update_or_create_snapshot(
+                kwargs['snapshot']
+            )
+            if created:
+                kwargs['snapshot'] = snapshot
+            else:
+                del kwargs['snapshot']
+
+        rows = self.__class__.objects.filter(
+            pk=self.pk,
+            token_code=self.token_code
+        ).update(**kwargs)
+
+        if rows:
+            if snapshot_id is not None:
+                _delete_snapshots([snapshot_id], self._state.db)
+            if to_state in states.ARCHIVED_STATES \
+                    and self.parent_id is not None:
+                self._count_parent(to_state)
+
+        return rows
+
+    def _count_parent(self, to_state):
+        counters = {'archived': 1}
+        if to_state == states.FINISHED:
+            counters['finished'] = 1
+        elif to_state == states.FAILED:
+            counters['failed'] = 1
+        self.__class__.objects._count_children(self.parent_id, **counters)
+
     def _lazy_transit(self, to_state, countdown=10):
         signals.lazy_transit.send(sender=self.__class__,
                                   activity_id=self.pk,
                                   to_state=to_state,
                                   countdown=countdown)
 
+    def _write_snapshot(self, snapshot):
+        """
+        Write ``snapshot`` of this activity, whose row has been transited
+        already.
+        """
+        obj, created = self._update_or_create_snapshot(snapshot)
+        if created:
+            self.__class__.objects.filter(pk=self.pk).update(snapshot=obj)
+            self.snapshot = obj
+
     def _update_or_create_snapshot(self, snapshot):
-        if isinstance(self.snapshot, ActivitySnapshot):
-            ActivitySnapshot.objects.filter(pk=self.snapshot.pk) \
-                                    .update(data=snapshot)
-            obj = self.snapshot
+        if self.snapshot_id is not None:
+            # reuse the loaded snapshot to write a delta against it,
+            # otherwise fetch its checksum only to skip unchanged writes
+            obj = getattr(self, self.__class__.snapshot.cache_name, None)
+            if obj is None:
+                obj = ActivitySnapshot.objects \
+                                      .only('checksum', 'delta_count') \
+                                      .get(pk=self.snapshot_id)
+            obj.save_content(snapshot)
             created = False
         else:
+            content = unwrap(snapshot)
             obj = ActivitySnapshot.objects.create(
                 data=snapshot,
+                checksum=hashlib.sha1(content).hexdigest(),
             )
+            obj.data = content
             created = True
 
         return obj, created
 
     @property
     def _snapshot(self):
-        if isinstance(self.snapshot, ActivitySnapshot):
-            return self.snapshot.data
-
-    @property
-    def args(self):
-        if isinstance(self.inputs, ActivityInputs):
-            return self.inputs.args
-        else:
-            return list()
-
-    @property
-    def kwargs(self):
-        if isinstance(self.inputs, ActivityInputs):
-            return self.inputs.kwargs
-        else:
-            return dict()
-
-    @property
-    def data(self):
-        if isinstance(self.outputs, ActivityOutputs):
-            return self.outputs.data
-
-    @property
-    def ex_data(self):
-        if isinstance(self.outputs, ActivityOutputs):
-            return self.outputs.ex_data
-
-    @property
-    def parent_id(self):
-        if hasattr(self, '_parent_id'):
-            return getattr(self, '_parent_id')
-        else:
-            try:
-                self._parent_id = ActivityRelationship.objects.get(
-                    descendant=self.pk,
-                    distance=1,
-                ).ancestor_id
-            except ActivityRelationship.DoesNotExist:
-                self._parent_id = None
-
-            return self._parent_id
-
-    @property
-    def parent(self):
-        if self.parent_id:
-            return self.__class__.objects.get(pk=self.parent_id)
+        if self.snapshot_id is not None:
+            return self.snapshot.content
+
+    def _payload(self, name):
+        try:
+            return getattr(self, name)
+        except ObjectDoesNotExist:
+            # payloads shared with an archived tree may have been moved
+            # to the archive meanwhile, they keep their primary keys.
+            archive = _PAYLOAD_MODELS[name][1]
+            return archive.objects.filter(pk=getattr(self, name + '_id')) \
+                                  .first()
 
     def pause(self):
         """
-        Pause this activity.
+        Pause this activity and its descendants.
         """
-        return self._appoint(states.SUSPENDED)
+        return bool(self.__class__.objects.suspend_subtree(self.pk))
 
     def revoke(self):
         """
-        Revoke this activity.
+        Revoke this activity and its descendants.
         """
-        return self._appoint(states.REVOKED)
+        return bool(self.__class__.objects.revoke_subtree(self.pk))
 
     def resume(self):
         u"""
@@ -469,10 +1331,12 @@ class ActivityModel(models.Model):
         2、恢复当前活动
         3、恢复子活动
         """
-        result = self._transit(states.READY)
-        if result:
-            self.descendants.exclude(token_code__isnull=True,
-                                     state__in=states.ARCHIVED_STATES)
+        result = bool(self.__class__.objects.resume_subtree(self.pk))
+        if self.state == states.BLOCKED:
+            if self.appointment == states.SUSPENDED:
+                self.appointment = ''
+            result = self._transit(states.READY) or result
+        return result
 
     def finish(self, data=None, ex_data=None, status_code=status.SUCCESS):
         """
@@ -494,6 +1358,144 @@ class ActivityModel(models.Model):
                                % (self.pk, self.state))
 
 
+class ActivityRelationshipManager(models.Manager):
+    """
+    Set-based maintenance of the closure table, rows are derived in the
+    database instead of being built one by one in python.
+    """
+
+    def _execute(self, sql, params=()):
+        qn = connections[self.db].ops.quote_name
+        sql = sql.format(
+            rel=qn(self.model._meta.db_table),
+            act=qn(ActivityModel._meta.db_table),
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def _subtree(self, ancestor_id):
+        # wrapped in a derived table, so that MySQL allows it in
+        # statements modifying the same table
+        return ("SELECT t.descendant_id FROM ("
+                "SELECT descendant_id FROM {rel} WHERE ancestor_id = %s"
+                ") t", [ancestor_id])
+
+    def attach(self, parent_id, descendant_ids):
+        """
+        Build the relationships of new leaf activities ``descendant_ids``
+        under ``parent_id`` out of the ancestors of the parent.
+        """
+        for chunk in _chunked(descendant_ids, 400):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            self._execute(
+                "INSERT INTO {rel} (ancestor_id, descendant_id, distance) "
+                "SELECT %s, a.id, 1 FROM {act} a "
+                "WHERE a.id IN (" + placeholders + ") "
+                "UNION ALL "
+                "SELECT r.ancestor_id, a.id, r.distance + 1 "
+                "FROM {rel} r, {act} a "
+                "WHERE r.descendant_id = %s "
+                "AND a.id IN (" + placeholders + ")",
+                [parent_id] + chunk + [parent_id] + chunk,
+            )
+
+    def delete_subtree(self, ancestor_id):
+        """
+        Delete all relationships of ``ancestor_id`` and its descendants.
+        """
+        subtree, params = self._subtree(ancestor_id)
+        return self._execute(
+            "DELETE FROM {rel} "
+            "WHERE descendant_id = %s OR descendant_id IN (" + subtree + ")",
+            [ancestor_id] + params,
+        )
+
+    @transaction.atomic
+    def move_subtree(self, ancestor_id, parent_id):
+        """
+        Move ``ancestor_id`` and its descendants under ``parent_id``.
+        """
+        if parent_id == ancestor_id or self.filter(
+                ancestor=ancestor_id, descendant=parent_id).exists():
+            raise ValueError("can not move activity #%s under its own "
+                             "descendant #%s" % (ancestor_id, parent_id))
+
+        subtree, params = self._subtree(ancestor_id)
+
+        # detach the subtree from its current ancestors
+        self._execute(
+            "DELETE FROM {rel} "
+            "WHERE (descendant_id = %s OR descendant_id IN (" + subtree + ")) "
+            "AND ancestor_id <> %s AND ancestor_id NOT IN (" + subtree + ")",
+            [ancestor_id] + params + [ancestor_id] + params,
+        )
+
+        # attach it to the new parent and the ancestors of the new parent
+        self._execute(
+            "INSERT INTO {rel} (ancestor_id, descendant_id, distance) "
+            "SELECT sup.ancestor_id, sub.descendant_id, "
+            "sup.distance + sub.distance + 1 "
+            "FROM (SELECT ancestor_id, distance FROM {rel} "
+            "      WHERE descendant_id = %s "
+            "      UNION ALL SELECT %s, 0) sup, "
+            "     (SELECT descendant_id, distance FROM {rel} "
+            "      WHERE ancestor_id = %s "
+            "      UNION ALL SELECT %s, 0) sub",
+            [parent_id, parent_id, ancestor_id, ancestor_id],
+        )
+
+        # keep the denormalized tree columns and the counters of children
+        # of both parents in sync
+        root_id = ActivityModel.objects.filter(pk=parent_id) \
+                                       .values_list('root_id', flat=True)[0]
+        old_parent_id, state, token_code = ActivityModel.objects.filter(
+            pk=ancestor_id,
+        ).values_list('parent_id', 'state', 'token_code')[0]
+        ActivityModel.objects.filter(pk=ancestor_id) \
+                             .update(parent=parent_id)
+        if token_code is not None:
+            counters = ActivityModel.objects._child_counters(state)
+            if old_parent_id is not None:
+                ActivityModel.objects._count_children(old_parent_id, **dict(
+                    (k, -v) for k, v in counters.iteritems()))
+            ActivityModel.objects._count_children(parent_id, **counters)
+        ActivityModel.objects.filter(
+            models.Q(pk=ancestor_id) |
+            models.Q(ancestor_set__ancestor=ancestor_id)
+        ).update(root=root_id)
+
+    def backfill(self, chunk_size=None):
+        """
+        Fill in the denormalized parents and roots of activities written
+        before they existed, out of their relationships, by ranges of
+        ``chunk_size`` primary keys. Returns the number of activities
+        filled in.
+        """
+        chunk_size = chunk_size or settings.MODBPM_SUBTREE_CHUNK_SIZE
+        bounds = ActivityModel.objects.filter(root__isnull=True) \
+                                      .aggregate(Min('pk'), Max('pk'))
+        if bounds['pk__min'] is None:
+            return 0
+
+        count = 0
+        for start in xrange(bounds['pk__min'], bounds['pk__max'] + 1,
+                            chunk_size):
+            with transaction.atomic():
+                count += self._execute(
+                    "UPDATE {act} SET "
+                    "parent_id = (SELECT ancestor_id FROM {rel} "
+                    "WHERE descendant_id = {act}.id AND distance = 1), "
+                    "root_id = COALESCE((SELECT ancestor_id FROM {rel} "
+                    "WHERE descendant_id = {act}.id "
+                    "ORDER BY distance DESC LIMIT 1), {act}.id) "
+                    "WHERE root_id IS NULL AND id >= %s AND id < %s",
+                    [start, start + chunk_size],
+                )
+        ActivityModel.objects.forget_all()
+        return count
+
+
 class ActivityRelationship(models.Model):
 
     ancestor = models.ForeignKey(
@@ -510,6 +1512,8 @@ class ActivityRelationship(models.Model):
         default=0
     )
 
+    objects = ActivityRelationshipManager()
+
     class Meta:
         unique_together = (('ancestor', 'descendant'),
                            ('descendant', 'distance'))
@@ -520,3 +1524,296 @@ class ActivityRelationship(models.Model):
             self.distance,
             self.descendant_id,
         ))
+
+
+class ActivityTimerManager(models.Manager):
+
+    def schedule(self, activity_id, to_state, countdown, rerun=False):
+        """
+        Transit ``activity_id`` to ``to_state`` in ``countdown`` seconds,
+        or with ``rerun`` run it again then if it is still in ``to_state``.
+
+        There is at most one pending timer per activity, target state and
+        kind, a request for a pending one only brings it forward if it is
+        due earlier.
+        """
+        due = now() + datetime.timedelta(seconds=countdown)
+        try:
+            with transaction.atomic():
+                self.create(activity_id=activity_id,
+                            to_state=to_state,
+                            rerun=rerun,
+                            due=due)
+        except IntegrityError:
+            self.filter(activity_id=activity_id,
+                        to_state=to_state,
+                        rerun=rerun,
+                        due__gt=due).update(due=due)
+
+        signals.timer_scheduled.send(sender=self.model,
+                                     activity_id=activity_id,
+                                     to_state=to_state,
+                                     due=due)
+
+    def due(self, limit, ahead=0):
+        """
+        Lock and return at most ``limit`` due timers, the earliest first.
+        Wakeups due within ``ahead`` seconds are returned as well, runs
+        deferred by :func:`modbpm.tasks.admit` are not.
+        """
+        current = now()
+        return list(self.select_for_update()
+                        .filter(Q(due__lte=current)
+                                | Q(to_state=states.READY,
+                                    rerun=False,
+                                    due__lte=current + datetime.timedelta(
+                                        seconds=ahead)))
+                        .order_by('due')[:limit])
+
+
+class ActivityTimer(models.Model):
+    """
+    A transition of an activity due at some time, written instead of a
+    countdown message and fired by :func:`modbpm.tasks.fire_timers`.
+    """
+
+    # not a foreign key, activities may be archived before their timers
+    # are fired, the poller drops timers of activities gone
+    activity_id = models.IntegerField()
+    to_state = models.CharField(max_length=16)
+    # a run deferred by modbpm.tasks.admit() rather than a transition
+    rerun = models.BooleanField(default=False)
+    due = models.DateTimeField(db_index=True)
+
+    objects = ActivityTimerManager()
+
+    class Meta:
+        unique_together = ('activity_id', 'to_state', 'rerun')
+
+    def __unicode__(self):
+        return unicode(u"#%s %s %s at %s" % (
+            self.activity_id,
+            'rerun in' if self.rerun else '->',
+            self.to_state,
+            self.due,
+        ))
+
+
+class ActivityThrottleManager(models.Manager):
+
+    def _lock(self, name, burst):
+        try:
+            with transaction.atomic():
+                self.create(name=name, tokens=burst, updated=now())
+        except IntegrityError:
+            pass
+        return self.select_for_update().get(name=name)
+
+    @transaction.atomic
+    def admit(self, act, max_running=None, max_rate=None, to_state=None):
+        """
+        Admit a run of ``act`` under the limits of its activity class, at
+        most ``max_running`` activities of the class running at once and
+        at most ``max_rate`` runs per second, then transit it to
+        ``to_state``.
+
+        Returns 0 once admitted, the number of seconds to wait if over the
+        limits, or None if ``act`` could not transit.
+
+        The row of the class is locked meanwhile, so that concurrent
+        workers admit activities of the class one after another.
+        """
+        burst = max(max_rate or 0, 1)
+        throttle = self._lock(act.name, burst)
+
+        if max_running and ActivityModel.objects.filter(
+                name=act.name,
+                state=states.RUNNING,
+        ).count() >= max_running:
+            return settings.MODBPM_THROTTLE_COUNTDOWN
+
+        if max_rate:
+            current = now()
+            elapsed = (current - throttle.updated).total_seconds()
+            tokens = min(burst, throttle.tokens + elapsed * max_rate)
+            if tokens < 1:
+                return (1 - tokens) / max_rate
+            self.filter(pk=throttle.pk).update(tokens=tokens - 1,
+                                               updated=current)
+
+        if to_state is not None and not act._transit(to_state):
+            return None
+        return 0
+
+
+class ActivityThrottle(models.Model):
+    """
+    Shared state of the limits of an activity class, a token bucket of
+    runs refilled at ``max_rate`` per second, see
+    :meth:`ActivityThrottleManager.admit`.
+    """
+
+    name = models.CharField(
+        max_length=100,
+        unique=True,
+    )
+    tokens = models.FloatField()
+    updated = models.DateTimeField()
+
+    objects = ActivityThrottleManager()
+
+    def __unicode__(self):
+        return unicode(u"%s (%.2f tokens)" % (self.name, self.tokens))
+
+
+# Cold archive of finished activity trees, see modbpm.archive. Rows keep
+# the primary keys and column names they had in the hot tables.
+
+
+class ArchivedActivityInputs(models.Model):
+
+    id = models.IntegerField(
+        primary_key=True,
+    )
+    args = CompressedIOField(
+        blank=True,
+    )
+    kwargs = CompressedIOField(
+        blank=True,
+    )
+
+    checksum = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+    )
+
+    def __unicode__(self):
+        return unicode(u"#%s" % self.pk)
+
+
+class ArchivedActivityOutputs(models.Model):
+
+    id = models.IntegerField(
+        primary_key=True,
+    )
+    data = CompressedIOField(
+        blank=True,
+    )
+    ex_data = CompressedIOField(
+        blank=True,
+    )
+
+    checksum = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+    )
+
+    def __unicode__(self):
+        return unicode(u"#%s" % self.pk)
+
+
+# hot and archived models of each payload
+_PAYLOAD_MODELS = {
+    'inputs': (ActivityInputs, ArchivedActivityInputs),
+    'outputs': (ActivityOutputs, ArchivedActivityOutputs),
+}
+
+
+class ArchivedActivityModel(ActivityPayloadMixin, models.Model):
+
+    id = models.IntegerField(
+        primary_key=True,
+    )
+    name = models.CharField(
+        max_length=100,
+    )
+    identifier_code = models.SlugField(
+        max_length=32,
+    )
+    token_code = models.SlugField(
+        max_length=6,
+        null=True,
+    )
+
+    parent_id = models.IntegerField(
+        null=True,
+        blank=True,
+        db_index=True,
+    )
+    root_id = models.IntegerField(
+        null=True,
+        blank=True,
+        db_index=True,
+    )
+
+    inputs_id = models.IntegerField(
+        null=True,
+        blank=True,
+    )
+    outputs_id = models.IntegerField(
+        null=True,
+        blank=True,
+    )
+
+    state = models.CharField(
+        max_length=16,
+    )
+    appointment = models.CharField(
+        max_length=16,
+        blank=True,
+    )
+    status_code = models.IntegerField(
+        blank=True,
+        null=True,
+    )
+    acknowledgment = models.PositiveSmallIntegerField(
+        default=0,
+    )
+
+    date_created = models.DateTimeField()
+    date_archived = models.DateTimeField(blank=True, null=True,
+                                         db_index=True)
+
+    def __unicode__(self):
+        return unicode(u"[#%d] %s" % (
+            self.pk,
+            self.name
+        ))
+
+    def _payload(self, name):
+        pk = getattr(self, name + '_id')
+        if pk is None:
+            return None
+
+        # payloads still referenced by hot activities stay in hot tables
+        for model in reversed(_PAYLOAD_MODELS[name]):
+            obj = model.objects.filter(pk=pk).first()
+            if obj is not None:
+                return obj
+
+    @property
+    def parent(self):
+        if self.parent_id is not None:
+            return ActivityModel.objects.get_any(pk=self.parent_id)
+
+
+class ArchivedActivityRelationship(models.Model):
+
+    ancestor_id = models.IntegerField(
+        db_index=True,
+    )
+    descendant_id = models.IntegerField(
+        db_index=True,
+    )
+    distance = models.PositiveSmallIntegerField(
+        default=0
+    )
+
+    def __unicode__(self):
+        return unicode(u"#%s -(%s)-> #%s" % (
+            self.ancestor_id,
+            self.distance,
+            self.descendant_id,
+        ))
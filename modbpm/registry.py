@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.registry
+===============
+
+Activity classes by dotted name, resolved once per worker process.
+
+The registry is filled when a worker process starts, from the modules
+listed in ``MODBPM_ACTIVITY_MODULES`` and from the ``modbpm.activities``
+entry points, see :func:`autodiscover`. Other names are imported on first
+use, unless ``MODBPM_ACTIVITY_REGISTRY_STRICT`` is set.
+"""
+from __future__ import absolute_import
+
+import importlib
+import inspect
+import logging
+import traceback
+
+from modbpm import exceptions
+from modbpm.conf import settings
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'modbpm.activities'
+
+_classes = {}
+_failures = {}  # name -> traceback of the failed import
+_discovered = False
+
+
+def activity_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def register(cls, name=None):
+    """
+    Register an activity class, under its dotted name by default.
+    """
+    _classes[name or activity_name(cls)] = cls
+    return cls
+
+
+def register_module(module):
+    """
+    Register the concrete activity classes defined in ``module``.
+    """
+    from modbpm.core.activity import AbstractActivity
+
+    for obj in vars(module).itervalues():
+        if inspect.isclass(obj) \
+                and issubclass(obj, AbstractActivity) \
+                and obj.__module__ == module.__name__ \
+                and not inspect.isabstract(obj):
+            register(obj)
+
+
+def _entry_points():
+    if pkg_resources is None:
+        return []
+    return pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+
+
+def autodiscover():
+    """
+    Fill the registry from the configured modules and entry points, an
+    entry point may refer to a module or to a single activity class.
+    """
+    global _discovered
+
+    for module_name in settings.MODBPM_ACTIVITY_MODULES:
+        try:
+            register_module(importlib.import_module(module_name))
+        except Exception:
+            logger.exception("can not load activity module %r"
+                             % module_name)
+
+    for entry_point in _entry_points():
+        try:
+            obj = entry_point.load()
+        except Exception:
+            logger.exception("can not load activity entry point %r"
+                             % entry_point.name)
+            continue
+        if inspect.ismodule(obj):
+            register_module(obj)
+        else:
+            register(obj)
+
+    _discovered = True
+    logger.info("%d activity classes registered" % len(_classes))
+
+
+def resolve(name):
+    """
+    Get the activity class of dotted ``name``, raise
+    :class:`~modbpm.exceptions.ImportException` if there is none.
+
+    Failed imports are remembered, they are not tried again for every
+    activity of the same name.
+    """
+    if not _discovered:
+        autodiscover()
+
+    try:
+        return _classes[name]
+    except KeyError:
+        pass
+
+    if name not in _failures:
+        if settings.MODBPM_ACTIVITY_REGISTRY_STRICT:
+            _failures[name] = "unknown activity: %r" % name
+        else:
+            module_name, _, cls_name = name.rpartition('.')
+            try:
+                module = importlib.import_module(module_name)
+                return register(getattr(module, cls_name), name)
+            except Exception:
+                _failures[name] = traceback.format_exc()
+
+    raise exceptions.ImportException(_failures[name])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+modbpm.routing
+==============
+
+Queues and priorities of engine tasks, chosen by the routing class of
+activities and by the kind of task.
+
+Activity classes declare their routing class, for example::
+
+    class Approval(AbstractTask):
+        routing_class = 'interactive'
+
+and ``MODBPM_ROUTES`` maps routing classes, or ``(routing class, task)``
+pairs, to options of ``apply_async``::
+
+    MODBPM_ROUTES = {
+        'interactive': {'queue': 'modbpm.interactive', 'priority': 9},
+        'batch': {'queue': 'modbpm.batch', 'priority': 0},
+        ('batch', 'initiate'): {'queue': 'modbpm.batch', 'priority': 3},
+    }
+
+where task is one of ``initiate``, ``schedule``, ``transit`` and
+``acknowledge``. Activities without routing class use the ``None`` key,
+or ``MODBPM_DEFAULT_ROUTING_CLASS``. Workers of interactive processes then
+consume their own queues, out of the reach of bulk runs::
+
+    celery worker -Q modbpm.interactive
+    celery worker -Q modbpm.batch,celery
+
+Acknowledgements, and tasks published by other code than the engine
+itself, are routed by :class:`Router` when it is listed in
+``CELERY_ROUTES``.
+"""
+from __future__ import absolute_import
+
+from modbpm import exceptions, registry
+from modbpm.conf import settings
+
+TASK_NAMES = frozenset(['initiate', 'schedule', 'transit', 'acknowledge'])
+
+# published by the engine with the options of route() already
+ROUTED_TASK_NAMES = frozenset(['initiate', 'schedule', 'transit'])
+
+_routing_classes = {}  # activity name -> routing class
+
+
+def routing_class(activity_name):
+    """
+    Get the routing class declared by the activity class of dotted
+    ``activity_name``, activity classes which can not be imported get the
+    default one.
+    """
+    try:
+        return _routing_classes[activity_name]
+    except KeyError:
+        pass
+
+    try:
+        cls = registry.resolve(activity_name)
+    except exceptions.ImportException:
+        cls = None
+    value = getattr(cls, 'routing_class', None) \
+        or settings.MODBPM_DEFAULT_ROUTING_CLASS
+
+    _routing_classes[activity_name] = value
+    return value
+
+
+def route(task_name, activity_name):
+    """
+    Get the options of ``apply_async`` for task ``task_name`` of an
+    activity of dotted ``activity_name``.
+    """
+    routes = settings.MODBPM_ROUTES
+    if not routes:
+        return {}
+
+    name = routing_class(activity_name)
+    options = dict(routes.get(name) or {})
+    options.update(routes.get((name, task_name)) or {})
+    return options
+
+
+class Router(object):
+    """
+    Celery router of engine tasks which are published without the options
+    of :func:`route`, it looks up the activity of each message. Tasks the
+    engine routes itself are left alone, so that their messages do not
+    cost a query each.
+    """
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        module_name, _, task_name = task.rpartition('.')
+        if module_name != 'modbpm.tasks' or task_name not in TASK_NAMES \
+                or task_name in ROUTED_TASK_NAMES or not args:
+            return None
+
+        from modbpm.models import ActivityModel
+
+        name = ActivityModel.objects.filter(pk=args[0]) \
+                                    .values_list('name', flat=True).first()
+        if name is None:
+            return None
+        return route(task_name, name) or None
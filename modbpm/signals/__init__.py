@@ -10,12 +10,17 @@ from __future__ import absolute_import
 from django.dispatch import Signal
 
 lazy_transit = Signal(providing_args=['activity_id', 'to_state', 'countdown'])
+timer_scheduled = Signal(providing_args=['activity_id', 'to_state', 'due'])
 
 activity_created = Signal(providing_args=['instance'])
+activities_created = Signal(providing_args=['instances'])
 activity_ready = Signal(providing_args=['instance'])
+activities_ready = Signal(providing_args=['instances'])
 activity_running = Signal(providing_args=['instance'])
 activity_blocked = Signal(providing_args=['instance'])
 activity_suspended = Signal(providing_args=['instance'])
+activities_suspended = Signal(providing_args=['instances'])
 activity_finished = Signal(providing_args=['instance'])
 activity_failed = Signal(providing_args=['instance'])
 activity_revoked = Signal(providing_args=['instance'])
+activities_revoked = Signal(providing_args=['instances'])
@@ -5,6 +5,8 @@ modbpm.signals.dispatch
 
 from __future__ import absolute_import
 
+from celery.signals import worker_process_init
+
 from modbpm import signals, tasks
 from modbpm.models import ActivityModel
 from modbpm.signals import handlers
@@ -12,6 +14,13 @@ from modbpm.signals import handlers
 DISPATCH_UID = __name__.replace('.', '_')
 
 
+def dispatch_worker_process_init():
+    worker_process_init.connect(
+        handlers.worker_process_init_handler,
+        dispatch_uid=DISPATCH_UID
+    )
+
+
 def dispatch_activity_lazy_transit():
     signals.lazy_transit.connect(
         handlers.activity_lazy_transit_handler,
@@ -28,6 +37,14 @@ def dispatch_activity_created():
     )
 
 
+def dispatch_activities_created():
+    signals.activities_created.connect(
+        handlers.activities_created_handler,
+        sender=ActivityModel,
+        dispatch_uid=DISPATCH_UID
+    )
+
+
 def dispatch_activity_ready():
     signals.activity_ready.connect(
         handlers.activity_ready_handler,
@@ -36,6 +53,14 @@ def dispatch_activity_ready():
     )
 
 
+def dispatch_activities_ready():
+    signals.activities_ready.connect(
+        handlers.activities_ready_handler,
+        sender=ActivityModel,
+        dispatch_uid=DISPATCH_UID
+    )
+
+
 def dispatch_activity_running():
     signals.activity_running.connect(
         handlers.activity_running_handler,
@@ -60,6 +85,14 @@ def dispatch_activity_suspended():
     )
 
 
+def dispatch_activities_suspended():
+    signals.activities_suspended.connect(
+        handlers.activities_suspended_handler,
+        sender=ActivityModel,
+        dispatch_uid=DISPATCH_UID
+    )
+
+
 def dispatch_activity_finished():
     signals.activity_finished.connect(
         handlers.activity_finished_handler,
@@ -89,21 +122,38 @@ def dispatch_activity_revoked():
     )
 
 
+def dispatch_activities_revoked():
+    signals.activities_revoked.connect(
+        handlers.activities_revoked_handler,
+        sender=ActivityModel,
+        dispatch_uid=DISPATCH_UID
+    )
+
+
 def dispatch_all():
+    dispatch_worker_process_init()
     dispatch_activity_lazy_transit()
     dispatch_activity_created()
+    dispatch_activities_created()
     dispatch_activity_ready()
+    dispatch_activities_ready()
     dispatch_activity_running()
     dispatch_activity_blocked()
     dispatch_activity_suspended()
+    dispatch_activities_suspended()
     dispatch_activity_finished()
     dispatch_activity_failed()
     dispatch_activity_revoked()
+    dispatch_activities_revoked()
 
 
 def dispatch():
+    dispatch_worker_process_init()
     dispatch_activity_lazy_transit()
     dispatch_activity_created()
+    dispatch_activities_created()
     dispatch_activity_ready()
+    dispatch_activities_ready()
     dispatch_activity_finished()
+    dispatch_activities_revoked()
 
@@ -9,9 +9,9 @@ from __future__ import absolute_import
 
 import logging
 
-from modbpm import states, tasks
+from modbpm import registry, routing, states, tasks
 from modbpm.conf import settings
-from modbpm.models import ActivityModel
+from modbpm.models import ActivityModel, ActivityTimer
 
 logger = logging.getLogger(__name__)
 
@@ -19,24 +19,59 @@ logger = logging.getLogger(__name__)
 def activity_lazy_transit_handler(sender, activity_id, to_state, countdown,
                                   **kwargs):
     logger.info("activity_lazy_transit_handler #%s" % activity_id)
-    tasks.transit.apply_async(args=(activity_id, to_state),
-                              countdown=countdown)
+    ActivityTimer.objects.schedule(activity_id, to_state, countdown)
+
+
+def worker_process_init_handler(**kwargs):
+    """
+    worker process init handler, fills the activity class registry.
+    """
+    registry.autodiscover()
 
 
 def activity_created_handler(sender, instance, **kwargs):
     """
     activity created handler.
     """
-    r = tasks.initiate.apply_async(args=(instance.pk,))
+    r = tasks.publish(tasks.initiate, (instance.pk,),
+                      **routing.route('initiate', instance.name))
     logger.info("activity_created_handler #%s %r" % (instance.pk, r))
 
 
+def activities_created_handler(sender, instances, **kwargs):
+    """
+    activities created handler, publishes all messages through one
+    producer.
+    """
+    with tasks.producer() as producer:
+        for instance in instances:
+            tasks.publish(tasks.initiate, (instance.pk,),
+                          producer=producer,
+                          **routing.route('initiate', instance.name))
+    logger.info("activities_created_handler #%s"
+                % ', #'.join(str(instance.pk) for instance in instances))
+
+
 def activity_ready_handler(sender, instance, **kwargs):
     """
     activity ready handler.
     """
     logger.info("activity_ready_handler #%s" % instance.pk)
-    tasks.schedule.apply_async(args=(instance.pk,))
+    tasks.publish(tasks.schedule, (instance.pk,),
+                  **routing.route('schedule', instance.name))
+
+
+def activities_ready_handler(sender, instances, **kwargs):
+    """
+    activities ready handler, publishes all messages through one producer.
+    """
+    with tasks.producer() as producer:
+        for instance in instances:
+            tasks.publish(tasks.schedule, (instance.pk,),
+                          producer=producer,
+                          **routing.route('schedule', instance.name))
+    logger.info("activities_ready_handler #%s"
+                % ', #'.join(str(instance.pk) for instance in instances))
 
 
 def activity_running_handler(sender, instance, **kwargs):
@@ -60,6 +95,13 @@ def activity_suspended_handler(sender, instance, **kwargs):
     pass
 
 
+def activities_suspended_handler(sender, instances, **kwargs):
+    """
+    activities suspended handler.
+    """
+    pass
+
+
 def activity_finished_handler(sender, instance, **kwargs):
     """
     activity finished handler.
@@ -75,6 +117,24 @@ def activity_failed_handler(sender, instance, **kwargs):
     pass
 
 
+def activity_revoked_handler(sender, instance, **kwargs):
+    """
+    activity revoked handler.
+    """
+    pass
+
+
+def activities_revoked_handler(sender, instances, **kwargs):
+    """
+    activities revoked handler, wakes up the parents of revoked subtrees,
+    parents revoked along with their children are left alone.
+    """
+    revoked = set(instance.pk for instance in instances)
+    for instance in instances:
+        if instance.parent_id not in revoked:
+            wake_up_parent_activity(instance)
+
+
 def wake_up_parent_activity(instance):
     parent = instance.parent
     if isinstance(parent, ActivityModel)\
@@ -84,7 +144,20 @@ def wake_up_parent_activity(instance):
             instance._ack()
             logger.info("activity #%s waked up by #%s"
                         % (parent.pk, instance.pk))
+        elif parent._defer_ack():
+            # the parent is woken up once for all children finished while
+            # it is running, as soon as it is blocked
+            logger.info("activity #%s acknowledged to running #%s"
+                        % (instance.pk, parent.pk))
         else:
-            countdown = settings.MODBPM_ACKNOWLEDGE_COUNTDOWN
-            tasks.acknowledge.apply_async(args=(instance.id,),
-                                          countdown=countdown)
+            parent = ActivityModel.objects.get(pk=parent.pk)
+            if parent.state == states.BLOCKED \
+                    and parent._transit(states.READY):
+                instance._ack()
+                logger.info("activity #%s waked up by #%s"
+                            % (parent.pk, instance.pk))
+            elif parent.state != states.READY:
+                # lost a race, try again a bit later
+                countdown = settings.MODBPM_ACKNOWLEDGE_COUNTDOWN
+                ActivityTimer.objects.schedule(parent.pk, states.READY,
+                                               countdown)
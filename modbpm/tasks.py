@@ -5,16 +5,26 @@ try:
 except ImportError:
     import pickle
 
+import collections
 import contextlib
+import datetime
+import functools
+import hashlib
 import logging
 import stackless
 import traceback
 
 from celery import task
 from celery.exceptions import SoftTimeLimitExceeded
+from django.db import transaction
+from django.utils.timezone import now
 
-from modbpm import signals, states, exceptions, messages
-from modbpm.models import ActivityModel
+from modbpm import (codec, registry, routing, signals, states, exceptions,
+                    messages)
+from modbpm.conf import settings
+from modbpm.models import (ActivityModel, ActivitySnapshot, ActivityThrottle,
+                           ActivityTimer)
+from modbpm.utils.collections import LRUCache
 
 
 logger = logging.getLogger(__name__)
@@ -44,6 +54,8 @@ def global_exception_handler(act):
 def import_exception_handler():
     try:
         yield
+    except exceptions.ImportException:
+        raise
     except:
         raise exceptions.ImportException(traceback.format_exc())
 
@@ -66,14 +78,211 @@ def runtime_exception_handler(backend):
         raise exceptions.RuntimeException(traceback.format_exc())
 
 
+def unit_of_work(func):
+    """
+    Run a task body in an identity scope of its own, so that activities
+    are not read again and again within one message.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with ActivityModel.objects.identity_scope():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# executor of engine tasks in this process instead of celery workers, see
+# modbpm.local
+_executor = None
+
+
+def set_executor(executor):
+    """
+    Hand engine tasks to ``executor.submit(task, args)`` rather than
+    publishing them, None to publish them again. Returns the executor
+    replaced.
+    """
+    global _executor
+
+    previous, _executor = _executor, executor
+    return previous
+
+
+class NullExecutor(object):
+    """
+    Drops engine tasks rather than running them, e.g. to measure the
+    transitions of activities alone.
+    """
+
+    def submit(self, task, args):
+        pass
+
+
+def producer():
+    """
+    A producer to publish several engine tasks through, None if they are
+    handed to a local executor.
+    """
+    if _executor is not None:
+        return contextlib.contextmanager(lambda: (yield None))()
+    return initiate.app.producer_or_acquire()
+
+
+def publish(task, args, **options):
+    """
+    Publish a message of engine task ``task``, or hand it to the local
+    executor. ``options`` are those of ``apply_async``.
+    """
+    if _executor is not None:
+        _executor.submit(task, args)
+        return None
+    return task.apply_async(args=args, **options)
+
+
+def dump_snapshot(backend):
+    return codec.wrap(backend.snapshot_codec, pickle.dumps(backend))
+
+
+# live backends of this worker process by activity id, with the checksum
+# and content of the snapshot they were dumped to
+_backends = None
+
+
+def _destroy_evicted(entry):
+    # the backend of another activity, its failure is not the current one's
+    try:
+        entry[2]._destroy()
+    except Exception:
+        logger.exception("failed to destroy an evicted backend")
+
+
+def backend_cache():
+    global _backends
+
+    if _backends is None and settings.MODBPM_BACKEND_CACHE_SIZE:
+        _backends = LRUCache(settings.MODBPM_BACKEND_CACHE_SIZE,
+                             on_evict=_destroy_evicted)
+    return _backends
+
+
+def load_backend(act):
+    """
+    Get the backend of ``act``, from the cache of this worker if its
+    snapshot has not changed since, otherwise from the snapshot.
+    """
+    cache = backend_cache()
+    entry = cache.pop(act.pk) if cache is not None else None
+    if entry is not None:
+        checksum, content, backend = entry
+        # already loaded by ActivityModel.objects.claim()
+        snapshot = act.snapshot_id is not None and (
+            getattr(act, ActivityModel.snapshot.cache_name, None)
+            or ActivitySnapshot.objects.only('checksum', 'delta_count')
+                                       .get(pk=act.snapshot_id))
+        if snapshot and snapshot.checksum == checksum:
+            # let the next snapshot be written as a delta of this one
+            snapshot._content = content
+            setattr(act, ActivityModel.snapshot.cache_name, snapshot)
+            return backend
+        backend._destroy()
+
+    return pickle.loads(act._snapshot)
+
+
+def keep_backend(act, snapshot, backend):
+    """
+    Keep the backend of a blocked activity alive in the cache of this
+    worker, returns False if it is not kept.
+    """
+    cache = backend_cache()
+    if cache is None or act.state != states.BLOCKED:
+        return False
+
+    content = codec.unwrap(snapshot)
+    backend._suspend()
+    return cache.put(act.pk,
+                     (hashlib.sha1(content).hexdigest(), content, backend),
+                     size=len(content))
+
+
+def limits(act, to_state=None):
+    """
+    Get the ``max_running`` and ``max_rate`` limits of the activity class
+    of ``act`` which apply to its transition to ``to_state``. Only runs
+    are limited, that is transitions to RUNNING, ``on_start()`` included.
+    """
+    if to_state != states.RUNNING:
+        return None, None
+
+    try:
+        cls = registry.resolve(act.name)
+    except exceptions.ImportException:
+        cls = None  # let the run fail on its own
+
+    return getattr(cls, 'max_running', None), getattr(cls, 'max_rate', None)
+
+
+def admit(act, to_state=None):
+    """
+    Admit a run of ``act`` under the limits of its activity class, and
+    transit it to ``to_state``. Returns False if ``act`` is not to run now,
+    runs over the limits are deferred by a timer to the current state.
+    """
+    max_running, max_rate = limits(act, to_state)
+    if not max_running and not max_rate:
+        return to_state is None or act._transit(to_state)
+
+    wait = ActivityThrottle.objects.admit(act, max_running, max_rate,
+                                          to_state)
+    if wait:
+        logger.info("activity #%s deferred for %.2fs" % (act.pk, wait))
+        ActivityTimer.objects.schedule(act.pk, act.state, wait, rerun=True)
+    return wait == 0
+
+
+def run_schedule(act):
+    """
+    Run a schedule of ready ``act``, returns its backend and the snapshot
+    to block it with, or None if it is not to run now.
+    """
+    # activities of a batch may have been transited already
+    if act.state != states.RUNNING and not admit(act, states.RUNNING):
+        return None
+
+    backend = load_backend(act)
+
+    with runtime_exception_handler(backend):
+        backend._resume()
+
+        stackless.schedule()
+        while backend._schedule():
+            stackless.schedule()
+
+    return backend, dump_snapshot(backend)
+
+
+def release_backend(act, snapshot, backend, blocked):
+    """
+    Keep or destroy the backend of ``act`` once it has been blocked with
+    ``snapshot``, and wake it up again for children finished meanwhile.
+    """
+    with runtime_exception_handler(backend):
+        if not keep_backend(act, snapshot, backend):
+            backend._destroy()
+
+    # children finished while running, wake up once for all
+    if blocked and act._drain_acks():
+        act._transit(states.READY)
+
+
 @task(ignore_result=True)
+@unit_of_work
 def initiate(act_id):
     query_kwargs = {
         'pk': act_id,
         'state': states.CREATED,
     }
     try:
-        act = ActivityModel.objects.get(**query_kwargs)
+        act = ActivityModel.objects.lookup(**query_kwargs)
     except ActivityModel.DoesNotExist:
         logger.info(
             messages.build_message(
@@ -85,11 +294,8 @@ def initiate(act_id):
         logger.info("initiate activity #%s" % act.pk)
 
         with global_exception_handler(act):
-            module_name, _, cls_name = act.name.rpartition('.')
-
             with import_exception_handler():
-                module = __import__(module_name, globals(), locals(), ['*'])
-                cls = getattr(module, cls_name)
+                cls = registry.resolve(act.name)
 
             with instantiation_exception_handler():
                 backend = cls(act.pk, act.name)
@@ -98,24 +304,27 @@ def initiate(act_id):
                 backend._initiate(*act.args, **act.kwargs)
 
             # if parent activity has an appointment state, inherit it.
-            if isinstance(act.parent, ActivityModel) \
-                    and act.parent.appointment in states.APPOINTABLE_STATES:
-                act._appoint(act.parent.appointment)
+            parent = act.parent_id and \
+                ActivityModel.objects.probe(pk=act.parent_id)
+            if isinstance(parent, ActivityModel) \
+                    and parent.appointment in states.APPOINTABLE_STATES:
+                act._appoint(parent.appointment)
 
-            act._transit(states.READY, snapshot=pickle.dumps(backend))
+            act._transit(states.READY, snapshot=dump_snapshot(backend))
 
             with runtime_exception_handler(backend):
                 backend._destroy()
 
 
 @task(ignore_result=True)
+@unit_of_work
 def schedule(act_id):
     query_kwargs = {
         'pk': act_id,
         'state': states.READY,
     }
     try:
-        act = ActivityModel.objects.get(**query_kwargs)
+        act = ActivityModel.objects.lookup(**query_kwargs)
     except ActivityModel.DoesNotExist:
         logger.info(
             messages.build_message(
@@ -127,29 +336,93 @@ def schedule(act_id):
         logger.info("schedule activity #%s" % act_id)
 
         with global_exception_handler(act):
-            if act._transit(states.RUNNING):
-                backend = pickle.loads(act.snapshot.data)
-
-                with runtime_exception_handler(backend):
-                    backend._resume()
-
-                    stackless.schedule()
-                    while backend._schedule():
-                        stackless.schedule()
+            ran = run_schedule(act)
+            if ran is not None:
+                backend, snapshot = ran
+                blocked = act._transit(states.BLOCKED, snapshot=snapshot)
+                release_backend(act, snapshot, backend, blocked)
 
-                act._transit(states.BLOCKED, snapshot=pickle.dumps(backend))
 
+@task(ignore_result=True)
+@unit_of_work
+def schedule_batch(act_ids):
+    """
+    Wake up and schedule the blocked activities of ``act_ids`` in this
+    worker, see :func:`fire_timers`. Activities are read and transited in
+    bulk, without signals, run one after another, then blocked with their
+    snapshots by one update per chunk.
+    """
+    # appointments are handled by single transitions
+    for act in ActivityModel.objects.filter(pk__in=act_ids,
+                                            state=states.BLOCKED) \
+                                    .exclude(appointment=''):
+        act._transit(states.READY)
+
+    acts = ActivityModel.objects.claim(act_ids)
+    logger.info("schedule %d activities" % len(acts))
+
+    # activities without limits are transited at once, the others are
+    # admitted one by one
+    ActivityModel.objects.transit_claimed(
+        [act for act in acts if not any(limits(act, states.RUNNING))],
+        states.RUNNING,
+    )
+
+    ran = []
+    for act in acts:
+        with global_exception_handler(act):
+            result = run_schedule(act)
+            if result is not None:
+                backend, snapshot = result
+                # keep its tasklets out of the schedules of the others
                 with runtime_exception_handler(backend):
-                    backend._destroy()
+                    backend._suspend()
+                ran.append((act, snapshot, backend))
+
+    blocked = dict(
+        (act.pk, True) for act in ActivityModel.objects.transit_claimed(
+            [act for act, _, _ in ran],
+            states.BLOCKED,
+            snapshots=dict((act.pk, snapshot) for act, snapshot, _ in ran),
+        )
+    )
+
+    # left out of the batch, e.g. appointed meanwhile
+    left = [act for act, _, _ in ran if act.pk not in blocked]
+    appointments = dict(ActivityModel.objects.filter(
+        pk__in=[act.pk for act in left],
+    ).values_list('pk', 'appointment'))
+    with transaction.atomic():
+        for act, snapshot, backend in ran:
+            if act.pk in blocked:
+                continue
+            act.appointment = appointments.get(act.pk, act.appointment)
+            with global_exception_handler(act):
+                with transaction.atomic():
+                    blocked[act.pk] = act._transit(states.BLOCKED,
+                                                   snapshot=snapshot)
+
+    # children finished while running, the others need no draining
+    pending = set(ActivityModel.objects.filter(
+        pk__in=[pk for pk, ok in blocked.iteritems() if ok],
+        pending_acks__gt=0,
+    ).values_list('pk', flat=True))
+    for act, snapshot, backend in ran:
+        with global_exception_handler(act):
+            release_backend(act, snapshot, backend, act.pk in pending)
 
 
 @task(ignore_result=True)
-def transit(act_id, to_state):
+@unit_of_work
+def transit(act_id, to_state, token_code=None):
     query_kwargs = {
         'pk': act_id,
     }
+    if token_code is not None:
+        # a subtree suspended or revoked since then has a fresh token
+        query_kwargs['token_code'] = token_code
     try:
-        act = ActivityModel.objects.get(**query_kwargs)
+        act = ActivityModel.objects.lookup(**query_kwargs)
     except ActivityModel.DoesNotExist:
         logger.info(
             messages.build_message(
@@ -165,13 +438,14 @@ def transit(act_id, to_state):
 
 
 @task(ignore_result=True)
+@unit_of_work
 def acknowledge(act_id):
     query_kwargs = {
         'pk': act_id,
         'acknowledgment': 0,
     }
     try:
-        act = ActivityModel.objects.get(**query_kwargs)
+        act = ActivityModel.objects.lookup(**query_kwargs)
     except ActivityModel.DoesNotExist:
         logger.info(
             messages.build_message(
@@ -184,3 +458,107 @@ def acknowledge(act_id):
 
         signals.activity_finished.send(sender=acknowledge,
                                        instance=act)
+
+
+@task(ignore_result=True)
+def fire_timers(limit=None):
+    """
+    Publish the transitions of due timers, ``limit`` per transaction.
+    Returns the number of published transitions.
+
+    Timers of running activities are postponed rather than published, the
+    transition would fail and the wakeup be lost. Timers of activities
+    which are gone, archived, suspended or already woken up are dropped.
+    Runs deferred by :func:`admit` are published again if the activity is
+    still created or ready, and dropped otherwise.
+
+    With ``MODBPM_BATCH_SCHEDULE_SIZE`` set, blocked activities due to be
+    woken up, or due within ``MODBPM_BATCH_SCHEDULE_WINDOW`` seconds, are
+    scheduled by batches of :func:`schedule_batch` instead of one transit
+    and one schedule message each.
+
+    Run it periodically, from celerybeat or the ``modbpm_timers`` command.
+    """
+    limit = limit or settings.MODBPM_TIMER_BATCH_SIZE
+    rerun_tasks = {
+        # initiations were deferred as well before only runs were limited
+        states.CREATED: ('initiate', initiate),
+        states.READY: ('schedule', schedule),
+    }
+    batch_size = settings.MODBPM_BATCH_SCHEDULE_SIZE
+    ahead = settings.MODBPM_BATCH_SCHEDULE_WINDOW if batch_size else 0
+    fired = 0
+    while True:
+        with transaction.atomic():
+            timers = ActivityTimer.objects.due(limit, ahead)
+            if not timers:
+                break
+
+            activities = dict(
+                (row[0], row[1:])
+                for row in ActivityModel.objects.filter(
+                    pk__in=[timer.activity_id for timer in timers]
+                ).values_list('pk', 'state', 'name', 'token_code')
+            )
+
+            postponed = set()
+            batches = collections.defaultdict(list)  # options -> ids
+            # published before the timers are deleted, a failed commit
+            # fires them twice, which guarded transitions tolerate
+            with producer() as broker:
+                for timer in timers:
+                    state, name, token_code = activities.get(
+                        timer.activity_id, (None, None, None))
+                    if timer.rerun:
+                        if state == timer.to_state and state in rerun_tasks:
+                            kind, rerun_task = rerun_tasks[state]
+                            publish(
+                                rerun_task,
+                                (timer.activity_id,),
+                                producer=broker,
+                                **routing.route(kind, name)
+                            )
+                            fired += 1
+                    elif state == states.RUNNING:
+                        postponed.add(timer.pk)
+                    elif batch_size and state == states.BLOCKED \
+                            and timer.to_state == states.READY:
+                        options = routing.route('schedule', name)
+                        batches[tuple(sorted(options.items()))] \
+                            .append(timer.activity_id)
+                    elif state != states.SUSPENDED \
+                            and states.can_transit(state, timer.to_state):
+                        publish(
+                            transit,
+                            (timer.activity_id, timer.to_state, token_code),
+                            producer=broker,
+                            **routing.route('transit', name)
+                        )
+                        fired += 1
+
+                for options, act_ids in batches.iteritems():
+                    for i in xrange(0, len(act_ids), batch_size):
+                        publish(
+                            schedule_batch,
+                            (act_ids[i:i + batch_size],),
+                            producer=broker,
+                            **dict(options)
+                        )
+                    fired += len(act_ids)
+
+            ActivityTimer.objects.filter(pk__in=postponed).update(
+                due=now() + datetime.timedelta(
+                    seconds=settings.MODBPM_ACKNOWLEDGE_COUNTDOWN + ahead
+                )
+            )
+            ActivityTimer.objects.filter(
+                pk__in=[timer.pk for timer in timers
+                        if timer.pk not in postponed]
+            )._raw_delete(ActivityTimer.objects.db)
+
+        if len(timers) < limit:
+            break
+
+    if fired:
+        logger.info("fired %d timers" % fired)
+    return fired
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+
+from modbpm import states, tasks
+from modbpm.core.activity.task import AbstractTask
+from modbpm.models import ActivityModel, ActivityTimer
+from modbpm.tests.utils import EngineTestCase
+
+
+class Poll(AbstractTask):
+
+    def on_start(self):
+        self.set_static_scheduler(self.on_schedule, 60)
+
+    def on_schedule(self):
+        pass
+
+
+class DeferredAckTest(EngineTestCase):
+
+    def finish(self, parent):
+        return self.walk(self.create(parent), states.READY, states.RUNNING,
+                         states.FINISHED)
+
+    def acks(self, parent):
+        return list(ActivityModel.objects.filter(parent=parent.pk)
+                                         .order_by('pk')
+                                         .values_list('acknowledgment',
+                                                      flat=True))
+
+    def test_blocked_parent_is_woken_up(self):
+        parent = self.walk(self.create(), states.READY, states.RUNNING,
+                           states.BLOCKED)
+
+        self.finish(parent)
+
+        self.assertEqual(self.reload(parent).state, states.READY)
+        self.assertEqual(self.acks(parent), [1])
+
+    def test_running_parent_defers_acks(self):
+        parent = self.walk(self.create(), states.READY, states.RUNNING)
+
+        self.finish(parent)
+        self.finish(parent)
+
+        parent = self.reload(parent)
+        self.assertEqual((parent.state, parent.pending_acks),
+                         (states.RUNNING, 2))
+        self.assertEqual(self.acks(parent), [0, 0])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_drain_acks(self):
+        parent = self.walk(self.create(), states.READY, states.RUNNING)
+        self.finish(parent)
+        self.create(parent)
+        parent = self.walk(parent, states.BLOCKED)
+
+        self.assertTrue(parent._drain_acks())
+
+        self.assertEqual(self.reload(parent).pending_acks, 0)
+        self.assertEqual(self.acks(parent), [1, 0])
+        self.assertFalse(parent._drain_acks())
+
+    def test_defer_ack_when_not_running(self):
+        parent = self.walk(self.create(), states.READY)
+
+        self.assertFalse(parent._defer_ack())
+        self.assertEqual(self.reload(parent).pending_acks, 0)
+
+    def test_schedule_drains_acks(self):
+        parent = self.create(name='%s.Poll' % __name__)
+        tasks.initiate(parent.pk)
+        self.finish(parent)
+        ActivityModel.objects.filter(pk=parent.pk).update(pending_acks=1)
+
+        tasks.schedule(parent.pk)
+
+        parent = self.reload(parent)
+        self.assertEqual((parent.state, parent.pending_acks),
+                         (states.READY, 0))
+        self.assertEqual(self.acks(parent), [1])
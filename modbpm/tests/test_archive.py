@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+import datetime
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+from modbpm import archive, states
+from modbpm.models import (ActivityModel, ActivityRelationship,
+                           ArchivedActivityModel, ArchivedActivityRelationship)
+from modbpm.tests.utils import EngineTestCase
+
+
+class ArchiveTest(EngineTestCase):
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.addCleanup(setattr, archive, 'CHUNK_SIZE', archive.CHUNK_SIZE)
+        archive.CHUNK_SIZE = 2
+
+    def finish(self, activity):
+        activity = self.reload(activity)
+        path = [states.READY, states.RUNNING, states.FINISHED]
+        if activity.state in path:
+            path = path[path.index(activity.state) + 1:]
+        return self.walk(activity, *path)
+
+    def build(self):
+        """
+        root
+        +-- a
+        |   +-- a1
+        +-- b
+        """
+        root = self.create()
+        a = self.create(root)
+        a1 = self.create(a)
+        b = self.create(root)
+        for act in (a1, b, a, root):
+            self.finish(act)
+        return root, a, a1, b
+
+    def test_archive_tree_larger_than_a_chunk(self):
+        root, a, a1, b = self.build()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                archive.archive(now() + datetime.timedelta(hours=1)), 1)
+
+        self.assertFalse(ActivityModel.objects.exists())
+        self.assertFalse(ActivityRelationship.objects.exists())
+        self.assertEqual(
+            dict(ArchivedActivityModel.objects.values_list('id',
+                                                           'parent_id')),
+            {root.pk: None, a.pk: root.pk, a1.pk: a.pk, b.pk: root.pk})
+        self.assertEqual(ArchivedActivityRelationship.objects.count(),
+                         1 + 2 + 1)
+
+        # no row is deleted while rows of later chunks still refer to it
+        writes = []
+        for query in queries.captured_queries:
+            for statement in ('UPDATE "modbpm_activitymodel"',
+                              'DELETE FROM "modbpm_activitymodel"'):
+                if statement in query['sql']:
+                    writes.append(statement.split()[0])
+        self.assertEqual(writes, ['UPDATE'] * 2 + ['DELETE'] * 2)
@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+from django.test import SimpleTestCase
+
+from modbpm import states, tasks
+from modbpm.utils.collections import LRUCache
+
+
+class Backend(object):
+
+    destroyed = False
+
+    def _suspend(self):
+        pass
+
+    def _destroy(self):
+        self.destroyed = True
+
+
+class Activity(object):
+
+    def __init__(self, pk, state=states.BLOCKED):
+        self.pk = pk
+        self.state = state
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.evicted = []
+        self.cache = LRUCache(10, on_evict=self.evicted.append)
+
+    def test_evict(self):
+        self.assertTrue(self.cache.put('a', 1, size=4))
+        self.assertTrue(self.cache.put('b', 2, size=4))
+        self.cache.get('a')
+        self.assertTrue(self.cache.put('c', 3, size=4))
+
+        self.assertEqual(self.evicted, [2])
+        self.assertEqual(self.cache.size, 8)
+
+    def test_replace(self):
+        self.cache.put('a', 1)
+        self.cache.put('a', 1)
+        self.assertEqual(self.evicted, [])
+
+        self.cache.put('a', 2)
+        self.assertEqual(self.evicted, [1])
+        self.assertEqual(self.cache.get('a'), 2)
+
+    def test_too_large(self):
+        self.cache.put('a', 1, size=4)
+
+        self.assertFalse(self.cache.put('a', 2, size=11))
+
+        # the replaced value is evicted, the rejected one is left to the caller
+        self.assertEqual(self.evicted, [1])
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_pop(self):
+        self.cache.put('a', 1)
+
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertEqual(self.evicted, [])
+
+
+class KeepBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, tasks, '_backends', tasks._backends)
+        tasks._backends = LRUCache(10, on_evict=tasks._destroy_evicted)
+
+    def test_evicted_backends_are_destroyed(self):
+        first, second = Backend(), Backend()
+
+        self.assertTrue(tasks.keep_backend(Activity(1), 'x' * 6, first))
+        self.assertTrue(tasks.keep_backend(Activity(2), 'x' * 6, second))
+
+        self.assertTrue(first.destroyed)
+        self.assertFalse(second.destroyed)
+
+    def test_replaced_backends_are_destroyed(self):
+        first, second = Backend(), Backend()
+
+        tasks.keep_backend(Activity(1), 'x', first)
+        tasks.keep_backend(Activity(1), 'y', second)
+
+        self.assertTrue(first.destroyed)
+        self.assertFalse(second.destroyed)
+
+    def test_backend_not_kept(self):
+        backend = Backend()
+
+        self.assertFalse(tasks.keep_backend(Activity(1), 'x' * 11, backend))
+        self.assertFalse(
+            tasks.keep_backend(Activity(2, states.READY), 'x', backend))
+        self.assertEqual(len(tasks._backends), 0)
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import datetime
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+from modbpm import states, tasks
+from modbpm.core.activity.task import AbstractTask
+from modbpm.models import ActivityModel, ActivityTimer
+from modbpm.tests.utils import EngineTestCase
+
+polls = []
+
+
+class Poll(AbstractTask):
+
+    def on_start(self):
+        self.set_static_scheduler(self.on_schedule, 60)
+
+    def on_schedule(self):
+        polls.append(self._act_id)
+
+
+class ScheduleBatchTest(EngineTestCase):
+
+    def setUp(self):
+        super(ScheduleBatchTest, self).setUp()
+        del polls[:]
+
+    def blocked(self, n):
+        pks = []
+        for _ in range(n):
+            act = self.create(name='%s.Poll' % __name__)
+            tasks.initiate(act.pk)
+            tasks.schedule(act.pk)
+            self.assertEqual(self.reload(act).state, states.BLOCKED)
+            pks.append(act.pk)
+        del polls[:]
+        return pks
+
+    def schedule_batch(self, pks):
+        with CaptureQueriesContext(connection) as queries:
+            tasks.schedule_batch(pks)
+        return [query['sql'] for query in queries.captured_queries
+                if 'UPDATE "modbpm_activitymodel"' in query['sql']]
+
+    def test_schedule_batch(self):
+        pks = self.blocked(3)
+        snapshots = dict(ActivityModel.objects.filter(pk__in=pks)
+                                              .values_list('pk', 'snapshot'))
+
+        tasks.schedule_batch(pks)
+
+        self.assertEqual(sorted(polls), pks)
+        for act in ActivityModel.objects.filter(pk__in=pks):
+            self.assertEqual(act.state, states.BLOCKED)
+            self.assertEqual(act.snapshot_id, snapshots[act.pk])
+
+    def test_updates_per_batch(self):
+        few = self.schedule_batch(self.blocked(2))
+        many = self.schedule_batch(self.blocked(6))
+
+        self.assertEqual(len(few), len(many))
+
+    def test_appointed_activities_are_left_out(self):
+        pks = self.blocked(2)
+        ActivityModel.objects.filter(pk=pks[0]).update(
+            appointment=states.SUSPENDED)
+
+        tasks.schedule_batch(pks)
+
+        self.assertEqual(
+            dict(ActivityModel.objects.filter(pk__in=pks)
+                                      .values_list('pk', 'state')),
+            {pks[0]: states.SUSPENDED, pks[1]: states.BLOCKED})
+
+
+class DueTimersTest(EngineTestCase):
+
+    def test_ahead(self):
+        act = self.create()
+        ActivityTimer.objects.schedule(act.pk, states.READY, 30)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 30, rerun=True)
+        ActivityTimer.objects.schedule(act.pk, states.FAILED, 30)
+
+        self.assertEqual(ActivityTimer.objects.due(10), [])
+        self.assertEqual(
+            [(timer.to_state, timer.rerun)
+             for timer in ActivityTimer.objects.due(10, ahead=60)],
+            [(states.READY, False)])
+
+    def test_due(self):
+        act = self.create()
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0, rerun=True)
+        ActivityTimer.objects.filter(activity_id=act.pk).update(
+            due=now() - datetime.timedelta(seconds=1))
+
+        self.assertEqual(len(ActivityTimer.objects.due(10, ahead=60)), 1)
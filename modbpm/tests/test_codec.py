@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+import zlib
+
+from django.test import SimpleTestCase
+
+from modbpm import codec
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class ZdictTest(SimpleTestCase):
+
+    def setUp(self):
+        self.samples = [pickle.dumps({
+            'status': 'finished',
+            'host': 'host-%d.example.com' % i,
+            'return_code': i % 3,
+        }, pickle.HIGHEST_PROTOCOL) for i in range(100)]
+        self.zdict = codec.train_dictionary(self.samples, size=4096)
+        # the loader of CompressionDictionary
+        self.addCleanup(codec.set_dictionary_loader,
+                        codec._dictionary_loader, codec._dictionary_ttl)
+
+    def test_round_trip(self):
+        for level in (None, 1, 9):
+            for sample in self.samples[:10]:
+                self.assertEqual(codec.zdict_decompress(
+                    codec.zdict_compress(sample, self.zdict, level),
+                    self.zdict,
+                ), sample)
+
+    def test_smaller_than_zlib(self):
+        self.assertLess(
+            sum(len(codec.zdict_compress(s, self.zdict))
+                for s in self.samples),
+            sum(len(zlib.compress(s)) for s in self.samples) / 2)
+
+    def test_codec(self):
+        dictionaries = {1: self.zdict}
+        codec.set_dictionary_loader(
+            lambda version: (1, self.zdict) if version is None
+            else (version, dictionaries[version]))
+        zdict = codec.Codec('pickle', 'zdict')
+        value = {'status': 'finished', 'host': 'host-0.example.com'}
+
+        encoded = zdict.encode(value)
+        self.assertLess(len(encoded), len(codec.Codec().encode(value)))
+        self.assertEqual(codec.decode(encoded), value)
+
+    def test_without_dictionary(self):
+        codec.set_dictionary_loader(lambda version: None)
+        zdict = codec.Codec('pickle', 'zdict')
+
+        self.assertEqual(zdict.encode('value'), codec.Codec().encode('value'))
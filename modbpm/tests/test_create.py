@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+from modbpm import states, tasks
+from modbpm.core.activity.process import AbstractBaseProcess
+from modbpm.core.activity.task import AbstractTask
+from modbpm.models import ActivityInputs, ActivityModel
+from modbpm.tests.utils import EngineTestCase
+
+
+class Leaf(AbstractTask):
+
+    def on_start(self, value):
+        pass
+
+
+class FanOut(AbstractBaseProcess):
+
+    def on_start(self):
+        self.set_parallel()
+        self.start_many(Leaf, [(i,) for i in range(3)])
+
+
+class CreateModelsTest(EngineTestCase):
+
+    def test_create_models(self):
+        parent = self.create()
+        self.executor.clear()
+
+        children = ActivityModel.objects.create_models(parent, [
+            ('modbpm.tests.Activity', (1,), {}),
+            ('modbpm.tests.Activity', (2,), {'x': 1}),
+            ('modbpm.tests.Activity', (1,), {}),
+            ('modbpm.tests.Activity', (), {}),
+        ])
+
+        pks = [child.pk for child in children]
+        children = [self.reload(child) for child in children]
+        self.assertEqual([child.parent_id for child in children],
+                         [parent.pk] * 4)
+        self.assertEqual([child.root_id for child in children],
+                         [parent.pk] * 4)
+        self.assertEqual([(child.args, child.kwargs) for child in children],
+                         [((1,), {}), ((2,), {'x': 1}), ((1,), {}), ([], {})])
+        # equal inputs share a payload
+        self.assertEqual(children[0].inputs_id, children[2].inputs_id)
+        self.assertIsNone(children[3].inputs_id)
+        self.assertEqual(ActivityInputs.objects.count(), 2)
+
+        self.assertEqual(self.reload(parent).children_created, 4)
+        self.assertEqual(self.executor.submitted,
+                         [('initiate', (pk,)) for pk in pks])
+
+    def test_create_roots(self):
+        roots = ActivityModel.objects.create_models(
+            None, [('modbpm.tests.Activity', (), {})] * 2)
+
+        for root in roots:
+            self.assertEqual(self.reload(root).root_id, root.pk)
+
+    def test_create_nothing(self):
+        self.assertEqual(ActivityModel.objects.create_models(None, []), [])
+        self.assertEqual(self.executor.submitted, [])
+
+    def test_start_many(self):
+        process = self.create(name='%s.FanOut' % __name__)
+        tasks.initiate(process.pk)
+        tasks.schedule(process.pk)
+
+        children = ActivityModel.objects.filter(parent=process.pk) \
+                                        .order_by('pk')
+        self.assertEqual([child.args for child in children],
+                         [(0,), (1,), (2,)])
+        self.assertEqual([child.state for child in children],
+                         [states.CREATED] * 3)
+        self.assertEqual(self.reload(process).children_created, 3)
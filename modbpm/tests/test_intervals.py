@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+
+import datetime
+
+from django.test import SimpleTestCase
+
+from modbpm import states
+from modbpm.core.activity import task
+from modbpm.core.activity.task import (AbstractTask,
+                                       AdaptiveIntervalGenerator,
+                                       DeadlineIntervalGenerator,
+                                       ExponentialIntervalGenerator,
+                                       NullIntervalGenerator,
+                                       StaticIntervalGenerator)
+from modbpm.models import ActivityModel
+from modbpm.tests.utils import EngineTestCase
+
+
+class Adaptive(AbstractTask):
+
+    def on_start(self):
+        self.set_adaptive_scheduler(self.on_schedule)
+
+    def on_schedule(self):
+        pass
+
+
+class FakeClockMixin(object):
+
+    def set_clock(self, cls, start=1000.0):
+        self.now = start
+        self.addCleanup(setattr, cls, 'clock', cls.__dict__['clock'])
+        cls.clock = staticmethod(lambda: self.now)
+
+
+class ExponentialIntervalGeneratorTest(SimpleTestCase):
+
+    def test_bounds(self):
+        generator = ExponentialIntervalGenerator(base=1, cap=60)
+        previous = generator.base
+        for _ in range(200):
+            interval = generator.next()
+            self.assertTrue(1 <= interval <= min(60, previous * 3),
+                            (previous, interval))
+            previous = interval
+        self.assertEqual(generator.count, 200)
+
+
+class DeadlineIntervalGeneratorTest(FakeClockMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.set_clock(DeadlineIntervalGenerator)
+
+    def test_deadline(self):
+        generator = DeadlineIntervalGenerator(
+            25, StaticIntervalGenerator(10))
+
+        intervals = []
+        for _ in range(4):
+            intervals.append(generator.next())
+            self.now += intervals[-1]
+
+        # polls at 10, 20, 25 then at the pace of the interval again
+        self.assertEqual(intervals, [10, 10, 5, 10])
+
+    def test_null_interval(self):
+        generator = DeadlineIntervalGenerator(25, NullIntervalGenerator())
+
+        self.assertIsNone(generator.next())
+
+
+class AdaptiveIntervalGeneratorTest(FakeClockMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.set_clock(AdaptiveIntervalGenerator)
+
+    def generator(self, times, age=0):
+        generator = AdaptiveIntervalGenerator('modbpm.tests.Activity',
+                                              StaticIntervalGenerator(7),
+                                              age=age)
+        generator.completion_times = lambda: times
+        return generator
+
+    def test_quantiles(self):
+        generator = self.generator(range(1, 21))
+
+        interval = generator.next()
+        # the 10% quantile, with jitter
+        self.assertTrue(2 <= interval <= 2 * 1.1, interval)
+
+        # 10 is the 50% quantile, the next one is 12
+        self.now += 10
+        interval = generator.next()
+        self.assertTrue(12 - 10 <= interval <= 12 * 1.1 - 10, interval)
+
+    def test_age(self):
+        generator = self.generator(range(1, 21), age=5)
+
+        interval = generator.next()
+        # the 30% quantile, the first one after the age
+        self.assertTrue(6 - 5 <= interval <= 6 * 1.1 - 5, interval)
+
+    def test_past_all_quantiles(self):
+        generator = self.generator(range(1, 21))
+        self.now += 100
+
+        self.assertEqual(generator.next(), 7)
+
+    def test_without_enough_history(self):
+        generator = self.generator(range(1, 10))
+
+        self.assertEqual(generator.next(), 7)
+
+
+class AdaptiveSchedulerTest(FakeClockMixin, EngineTestCase):
+
+    def setUp(self):
+        super(AdaptiveSchedulerTest, self).setUp()
+        self.set_clock(AdaptiveIntervalGenerator)
+
+    def test_measured_from_creation(self):
+        act = self.create(name='%s.Adaptive' % __name__)
+        ActivityModel.objects.filter(pk=act.pk).update(
+            date_created=act.date_created - datetime.timedelta(seconds=60))
+        backend = Adaptive(act.pk, act.name)
+
+        backend.set_adaptive_scheduler(backend.on_schedule)
+
+        self.assertAlmostEqual(backend._interval.started, self.now - 60,
+                               delta=5)
+
+
+class CompletionTimesTest(EngineTestCase):
+
+    def setUp(self):
+        super(CompletionTimesTest, self).setUp()
+        task._completion_times.clear()
+        self.addCleanup(task._completion_times.clear)
+
+    def finish(self, seconds):
+        act = self.walk(self.create(), states.READY, states.RUNNING,
+                        states.FINISHED)
+        ActivityModel.objects.filter(pk=act.pk).update(
+            date_created=act.date_archived - datetime.timedelta(
+                seconds=seconds))
+
+    def test_completion_times(self):
+        for seconds in (30, 10, 20):
+            self.finish(seconds)
+        self.create()
+
+        self.assertEqual(task.completion_times('modbpm.tests.Activity'),
+                         [10, 20, 30])
+
+    def test_cached(self):
+        self.finish(10)
+        task.completion_times('modbpm.tests.Activity')
+        self.finish(20)
+
+        self.assertEqual(task.completion_times('modbpm.tests.Activity'),
+                         [10])
+
+        task._completion_times['modbpm.tests.Activity'] = (0, [])
+        self.assertEqual(task.completion_times('modbpm.tests.Activity'),
+                         [10, 20])
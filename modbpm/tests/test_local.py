@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+from modbpm import states, tasks
+from modbpm.core.activity.process import AbstractBaseProcess
+from modbpm.core.activity.task import AbstractTask
+from modbpm.local import LocalEngine
+from modbpm.models import ActivityModel
+from modbpm.tests.utils import EngineTestCase
+
+
+class Echo(AbstractTask):
+
+    def on_start(self, value):
+        self.finish(value)
+
+
+class Poll(AbstractTask):
+
+    def on_start(self):
+        self.set_static_scheduler(self.on_schedule, 1)
+
+    def on_schedule(self):
+        if self.schedule_count > 2:
+            self.finish(self.schedule_count)
+
+
+class Sequence(AbstractBaseProcess):
+
+    def on_start(self):
+        first = self.start(Echo)('first')
+        self.start(Echo)(first)
+        self.start(Poll)()
+
+
+class LocalEngineTest(EngineTestCase):
+
+    def test_inline(self):
+        with LocalEngine(workers=0) as engine:
+            process = self.create(name='%s.Sequence' % __name__)
+            self.assertTrue(engine.wait(timeout=30))
+
+        process = self.reload(process)
+        self.assertEqual(process.state, states.FINISHED)
+        children = ActivityModel.objects.filter(parent=process.pk) \
+                                        .order_by('pk')
+        self.assertEqual([child.state for child in children],
+                         [states.FINISHED] * 3)
+        self.assertEqual([child.data for child in children],
+                         ['first', 'first', 3])
+
+    def test_wait_timeout(self):
+        with LocalEngine(workers=0) as engine:
+            self.create(name='%s.Poll' % __name__)
+            self.assertFalse(engine.wait(timeout=0.1))
+
+    def test_executor_restored(self):
+        with LocalEngine(workers=0):
+            self.assertIsNot(tasks._executor, self.executor)
+
+        self.assertIs(tasks._executor, self.executor)
+        self.create()
+        self.assertEqual(self.executor.names(), ['initiate'])
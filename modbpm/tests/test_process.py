@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+from modbpm import states, tasks
+from modbpm.core.activity.process import (AbstractBaseProcess,
+                                          AbstractParallelProcess,
+                                          StrictScheduleMixin)
+from modbpm.core.activity.task import AbstractTask
+from modbpm.models import ActivityModel
+from modbpm.tests.utils import EngineTestCase
+
+joined = []
+
+
+class Leaf(AbstractTask):
+
+    def on_start(self):
+        pass
+
+
+class Pair(AbstractBaseProcess):
+
+    def on_start(self):
+        self.set_parallel()
+        a = self.start(Leaf)()
+        b = self.start(Leaf)()
+        a.join()
+        joined.append('a')
+        b.join()
+        joined.append('b')
+
+
+class StrictPair(StrictScheduleMixin, AbstractParallelProcess):
+
+    def on_start(self):
+        a = self.start(Leaf)()
+        b = self.start(Leaf)()
+        a.join()
+        joined.append('a')
+        b.join()
+        joined.append('b')
+        self.finish()
+
+
+class JoinTest(EngineTestCase):
+
+    def setUp(self):
+        super(JoinTest, self).setUp()
+        del joined[:]
+
+    def run_process(self, cls):
+        process = self.create(name='%s.%s' % (cls.__module__, cls.__name__))
+        tasks.initiate(process.pk)
+        tasks.schedule(process.pk)
+
+        process = self.reload(process)
+        self.assertEqual(process.state, states.BLOCKED)
+        return process
+
+    def finish(self, process, child):
+        self.walk(child, states.READY, states.RUNNING, states.FINISHED)
+        process = self.reload(process)
+        if process.state == states.BLOCKED:
+            process._transit(states.READY)
+        tasks.schedule(process.pk)
+        return self.reload(process)
+
+    def children(self, process):
+        return list(ActivityModel.objects.filter(parent=process.pk)
+                                         .order_by('pk'))
+
+    def test_join_out_of_order(self):
+        process = self.run_process(Pair)
+        a, b = self.children(process)
+
+        process = self.finish(process, b)
+        self.assertEqual(joined, [])
+        self.assertEqual(process.state, states.BLOCKED)
+
+        process = self.finish(process, a)
+        self.assertEqual(joined, ['a', 'b'])
+        self.assertEqual(process.state, states.FINISHED)
+
+    def test_join_without_collecting_schedule(self):
+        process = self.run_process(StrictPair)
+        a, b = self.children(process)
+
+        process = self.finish(process, b)
+        self.assertEqual(joined, [])
+
+        process = self.finish(process, a)
+        self.assertEqual(joined, ['a', 'b'])
+        self.assertEqual(process.state, states.FINISHED)
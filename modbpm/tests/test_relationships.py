@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+
+from modbpm import states
+from modbpm.models import ActivityModel, ActivityRelationship
+from modbpm.tests.utils import EngineTestCase
+
+
+class ActivityRelationshipManagerTest(EngineTestCase):
+
+    def closure(self, activity):
+        return sorted(ActivityRelationship.objects.filter(
+            descendant=activity.pk,
+        ).values_list('ancestor_id', 'distance'))
+
+    def build(self):
+        """
+        root
+        +-- a
+        |   +-- a1
+        |       +-- a11
+        +-- b
+        """
+        root = self.create()
+        a = self.create(root)
+        a1 = self.create(a)
+        a11 = self.create(a1)
+        b = self.create(root)
+        return root, a, a1, a11, b
+
+    def test_attach(self):
+        root, a, a1, a11, b = self.build()
+
+        self.assertEqual(self.closure(root), [])
+        self.assertEqual(self.closure(a), [(root.pk, 1)])
+        self.assertEqual(self.closure(a11),
+                         [(root.pk, 3), (a.pk, 2), (a1.pk, 1)])
+        self.assertEqual(ActivityRelationship.objects.count(), 1 + 2 + 3 + 1)
+
+    def test_attach_many(self):
+        root = self.create()
+        parent = self.create(root)
+        children = ActivityModel.objects.create_models(
+            parent, [('modbpm.tests.Activity', (i,), {}) for i in range(3)])
+
+        for child in children:
+            self.assertEqual(self.closure(child),
+                             [(root.pk, 2), (parent.pk, 1)])
+        self.assertEqual(ActivityRelationship.objects.count(), 1 + 3 * 2)
+
+    def test_delete_subtree(self):
+        root, a, a1, a11, b = self.build()
+
+        deleted = ActivityRelationship.objects.delete_subtree(a.pk)
+
+        # rows of a, a1 and a11, those of b are left alone
+        self.assertEqual(deleted, 1 + 2 + 3)
+        self.assertEqual(ActivityRelationship.objects.count(), 1)
+        self.assertEqual(self.closure(b), [(root.pk, 1)])
+
+    def test_move_subtree(self):
+        root, a, a1, a11, b = self.build()
+
+        ActivityRelationship.objects.move_subtree(a1.pk, b.pk)
+
+        self.assertEqual(self.closure(a1), [(root.pk, 2), (b.pk, 1)])
+        self.assertEqual(self.closure(a11),
+                         [(root.pk, 3), (a1.pk, 1), (b.pk, 2)])
+        self.assertEqual(self.closure(a), [(root.pk, 1)])
+        self.assertFalse(ActivityRelationship.objects.filter(
+            ancestor=a.pk).exclude(descendant=a.pk).exists())
+        self.assertEqual(ActivityRelationship.objects.count(), 1 + 2 + 3 + 1)
+
+        a1, a11 = self.reload(a1), self.reload(a11)
+        self.assertEqual(a1.parent_id, b.pk)
+        self.assertEqual(a11.parent_id, a1.pk)
+        self.assertEqual((a1.root_id, a11.root_id), (root.pk, root.pk))
+
+    def test_move_subtree_to_another_tree(self):
+        root, a, a1, a11, b = self.build()
+        other = self.create()
+
+        ActivityRelationship.objects.move_subtree(a.pk, other.pk)
+
+        self.assertEqual(self.closure(a11),
+                         [(a.pk, 2), (a1.pk, 1), (other.pk, 3)])
+        self.assertEqual(
+            set(ActivityModel.objects.filter(pk__in=[a.pk, a1.pk, a11.pk])
+                                     .values_list('root_id', flat=True)),
+            set([other.pk]))
+
+    def test_move_subtree_under_own_descendant(self):
+        root, a, a1, a11, b = self.build()
+
+        for target in (a.pk, a1.pk, a11.pk):
+            self.assertRaises(ValueError,
+                              ActivityRelationship.objects.move_subtree,
+                              a.pk, target)
+
+        self.assertEqual(self.closure(a11),
+                         [(root.pk, 3), (a.pk, 2), (a1.pk, 1)])
+        self.assertEqual(self.reload(a).parent_id, root.pk)
+
+    def test_backfill(self):
+        root, a, a1, a11, b = self.build()
+        other = self.create()
+        tree = dict(ActivityModel.objects.values_list('pk', 'parent_id'))
+        ActivityModel.objects.update(parent=None, root=None)
+
+        self.assertEqual(ActivityRelationship.objects.backfill(chunk_size=2),
+                         6)
+
+        self.assertEqual(
+            dict(ActivityModel.objects.values_list('pk', 'parent_id')), tree)
+        self.assertEqual(
+            dict(ActivityModel.objects.values_list('pk', 'root_id')),
+            {root.pk: root.pk, a.pk: root.pk, a1.pk: root.pk,
+             a11.pk: root.pk, b.pk: root.pk, other.pk: other.pk})
+        self.assertEqual(ActivityRelationship.objects.backfill(), 0)
+
+
+class ChildCountersTest(EngineTestCase):
+
+    def counters(self, activity):
+        return ActivityModel.objects.filter(pk=activity.pk).values_list(
+            'children_created', 'children_archived',
+            'children_finished', 'children_failed')[0]
+
+    def build(self):
+        root = self.create()
+        a = self.create(root)
+        b = self.create(root)
+        self.walk(self.create(a), states.READY, states.RUNNING,
+                  states.FINISHED)
+        self.walk(self.create(a), states.READY, states.RUNNING,
+                  states.FAILED)
+        self.create(a)
+        return root, a, b
+
+    def test_counters(self):
+        root, a, b = self.build()
+
+        self.assertEqual(self.counters(root), (2, 0, 0, 0))
+        self.assertEqual(self.counters(a), (3, 2, 1, 1))
+        self.assertEqual(self.counters(b), (0, 0, 0, 0))
+
+    def test_move_subtree(self):
+        root, a, b = self.build()
+        finished, failed, created = ActivityModel.objects.filter(
+            parent=a.pk).order_by('pk')
+
+        ActivityRelationship.objects.move_subtree(finished.pk, b.pk)
+        ActivityRelationship.objects.move_subtree(created.pk, b.pk)
+
+        self.assertEqual(self.counters(a), (1, 1, 0, 1))
+        self.assertEqual(self.counters(b), (2, 1, 1, 0))
+        self.assertEqual(self.counters(root), (2, 0, 0, 0))
+
+    def test_backfill_counters(self):
+        root, a, b = self.build()
+        counters = [self.counters(act) for act in (root, a, b)]
+        ActivityModel.objects.update(children_created=0, children_archived=0,
+                                     children_finished=0, children_failed=0)
+
+        self.assertEqual(
+            ActivityModel.objects.backfill_counters(chunk_size=1), 2)
+
+        self.assertEqual([self.counters(act) for act in (root, a, b)],
+                         counters)
+        self.assertEqual(ActivityModel.objects.backfill_counters(), 0)
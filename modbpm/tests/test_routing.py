@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+from django.test.utils import override_settings
+
+from modbpm import routing
+from modbpm.tests.utils import EngineTestCase
+
+ROUTES = {
+    None: {'queue': 'modbpm.default'},
+    (None, 'acknowledge'): {'priority': 3},
+}
+
+
+@override_settings(MODBPM_ROUTES=ROUTES)
+class RouterTest(EngineTestCase):
+
+    def setUp(self):
+        super(RouterTest, self).setUp()
+        self.router = routing.Router()
+        self.act = self.create()
+
+    def test_routed_by_the_engine(self):
+        for task_name in routing.ROUTED_TASK_NAMES:
+            with self.assertNumQueries(0):
+                self.assertIsNone(self.router.route_for_task(
+                    'modbpm.tasks.%s' % task_name, (self.act.pk,)))
+
+    def test_acknowledge(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.router.route_for_task('modbpm.tasks.acknowledge',
+                                           (self.act.pk,)),
+                {'queue': 'modbpm.default', 'priority': 3})
+
+    def test_unknown(self):
+        self.assertIsNone(self.router.route_for_task(
+            'modbpm.tasks.acknowledge', (self.act.pk + 1,)))
+        self.assertIsNone(self.router.route_for_task(
+            'other.tasks.acknowledge', (self.act.pk,)))
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+from modbpm import states, tasks
+from modbpm.models import ActivityModel, ActivityTimer
+from modbpm.tests.utils import EngineTestCase
+
+
+class SubtreeTest(EngineTestCase):
+
+    def build(self):
+        """
+        root (READY)
+        +-- a (READY)
+        +-- b (BLOCKED)
+        """
+        root = self.walk(self.create(), states.READY)
+        a = self.walk(self.create(root), states.READY)
+        b = self.walk(self.create(root), states.READY, states.RUNNING,
+                      states.BLOCKED)
+        for act in (root, a, b):
+            ActivityTimer.objects.schedule(act.pk, states.READY, 60)
+        self.executor.clear()
+        return root, a, b
+
+    def test_suspend(self):
+        root, a, b = self.build()
+
+        self.assertEqual(ActivityModel.objects.suspend_subtree(root.pk), 3)
+
+        self.assertEqual(
+            [(act.state, act.appointment)
+             for act in map(self.reload, (root, a, b))],
+            [(states.SUSPENDED, ''), (states.SUSPENDED, ''),
+             (states.BLOCKED, states.SUSPENDED)])
+        self.assertEqual(
+            list(ActivityTimer.objects.values_list('activity_id', flat=True)),
+            [b.pk])
+
+    def test_queued_transit_after_suspend(self):
+        root, a, b = self.build()
+
+        ActivityModel.objects.suspend_subtree(root.pk)
+        tasks.transit(a.pk, states.READY, a.token_code)
+
+        self.assertEqual(self.reload(a).state, states.SUSPENDED)
+
+    def test_queued_transit_after_resume(self):
+        root, a, b = self.build()
+
+        ActivityModel.objects.suspend_subtree(root.pk)
+        ActivityModel.objects.resume_subtree(root.pk)
+        tasks.transit(a.pk, states.RUNNING, a.token_code)
+
+        self.assertEqual(self.reload(a).state, states.READY)
+
+    def test_revoke(self):
+        root, a, b = self.build()
+
+        self.assertEqual(ActivityModel.objects.revoke_subtree(root.pk), 3)
+        tasks.transit(a.pk, states.RUNNING, a.token_code)
+
+        self.assertEqual(
+            [act.state for act in map(self.reload, (root, a, b))],
+            [states.REVOKED] * 3)
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_resume(self):
+        root, a, b = self.build()
+        ActivityModel.objects.suspend_subtree(root.pk)
+        self.executor.clear()
+
+        self.assertEqual(ActivityModel.objects.resume_subtree(root.pk), 3)
+
+        self.assertEqual(
+            [(act.state, act.appointment)
+             for act in map(self.reload, (root, a, b))],
+            [(states.READY, ''), (states.READY, ''), (states.BLOCKED, '')])
+        self.assertEqual(sorted(args[0] for name, args
+                                in self.executor.submitted
+                                if name == 'schedule'),
+                         [root.pk, a.pk])
+
+    def test_fired_transit_carries_token(self):
+        root, a, b = self.build()
+        ActivityTimer.objects.filter(activity_id__in=[root.pk, a.pk]) \
+                             .delete()
+        ActivityTimer.objects.schedule(b.pk, states.READY, 0)
+
+        tasks.fire_timers()
+
+        self.assertEqual(self.executor.submitted,
+                         [('transit', (b.pk, states.READY, b.token_code))])
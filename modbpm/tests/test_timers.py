@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+
+from django.utils.timezone import now
+
+from modbpm import states, tasks
+from modbpm.core.activity.task import AbstractTask
+from modbpm.models import ActivityModel, ActivityThrottle, ActivityTimer
+from modbpm.tests.utils import EngineTestCase
+
+THROTTLED = '%s.Throttled' % __name__
+
+
+class Throttled(AbstractTask):
+
+    max_running = 1
+
+    def on_start(self):
+        pass
+
+
+class RateLimited(AbstractTask):
+
+    max_rate = 2
+
+    def on_start(self):
+        pass
+
+
+class ThrottleTest(EngineTestCase):
+
+    def test_admit_over_limit(self):
+        running = self.walk(self.create(name=THROTTLED),
+                            states.READY, states.RUNNING)
+        ready = self.walk(self.create(name=THROTTLED), states.READY)
+
+        self.assertFalse(tasks.admit(ready, states.RUNNING))
+        self.assertEqual(self.reload(ready).state, states.READY)
+        timer = ActivityTimer.objects.get(activity_id=ready.pk)
+        self.assertEqual((timer.to_state, timer.rerun), (states.READY, True))
+
+        self.walk(running, states.BLOCKED)
+        self.assertTrue(tasks.admit(self.reload(ready), states.RUNNING))
+        self.assertEqual(self.reload(ready).state, states.RUNNING)
+
+    def test_start_takes_one_token(self):
+        act = self.create(name='%s.RateLimited' % __name__)
+
+        tasks.initiate(act.pk)
+        tasks.schedule(act.pk)
+
+        self.assertNotEqual(self.reload(act).state, states.READY)
+        self.assertEqual(ActivityThrottle.objects.get(name=act.name).tokens,
+                         1)
+
+    def test_rerun_and_wakeup_timers_coexist(self):
+        act = self.create(name=THROTTLED)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0, rerun=True)
+
+        self.assertEqual(
+            ActivityTimer.objects.filter(activity_id=act.pk).count(), 2)
+
+
+class FireRerunTimersTest(EngineTestCase):
+
+    def test_rerun(self):
+        act = self.walk(self.create(), states.READY)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0, rerun=True)
+        self.executor.clear()
+
+        self.assertEqual(tasks.fire_timers(), 1)
+        self.assertEqual(self.executor.submitted, [('schedule', (act.pk,))])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_rerun_of_created(self):
+        act = self.create()
+        ActivityTimer.objects.schedule(act.pk, states.CREATED, 0, rerun=True)
+        self.executor.clear()
+
+        tasks.fire_timers()
+        self.assertEqual(self.executor.submitted, [('initiate', (act.pk,))])
+
+    def test_stale_rerun_is_dropped(self):
+        act = self.walk(self.create(), states.READY, states.RUNNING,
+                        states.BLOCKED)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0, rerun=True)
+        self.executor.clear()
+
+        self.assertEqual(tasks.fire_timers(), 0)
+        self.assertEqual(self.executor.submitted, [])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_stale_wakeup_is_not_rerun(self):
+        act = self.walk(self.create(), states.READY)
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0)
+        self.executor.clear()
+
+        self.assertEqual(tasks.fire_timers(), 0)
+        self.assertEqual(self.executor.submitted, [])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+
+class ScheduleTimersTest(EngineTestCase):
+
+    def test_lazy_transit(self):
+        act = self.walk(self.create(), states.READY, states.RUNNING,
+                        states.BLOCKED)
+        self.executor.clear()
+
+        act._lazy_transit(states.READY, countdown=30)
+
+        timer = ActivityTimer.objects.get()
+        self.assertEqual((timer.activity_id, timer.to_state, timer.rerun),
+                         (act.pk, states.READY, False))
+        self.assertEqual(self.executor.submitted, [])
+
+
+class CoalesceTimersTest(EngineTestCase):
+
+    def test_coalesce(self):
+        act = self.create()
+
+        ActivityTimer.objects.schedule(act.pk, states.READY, 60)
+        due = ActivityTimer.objects.get().due
+        ActivityTimer.objects.schedule(act.pk, states.READY, 30)
+        earlier = ActivityTimer.objects.get().due
+        ActivityTimer.objects.schedule(act.pk, states.READY, 90)
+
+        self.assertLess(earlier, due)
+        self.assertEqual(ActivityTimer.objects.get().due, earlier)
+
+    def test_one_timer_per_state(self):
+        act = self.create()
+
+        ActivityTimer.objects.schedule(act.pk, states.READY, 30)
+        ActivityTimer.objects.schedule(act.pk, states.FAILED, 30)
+
+        self.assertEqual(ActivityTimer.objects.count(), 2)
+
+
+class FireTimersTest(EngineTestCase):
+
+    def blocked(self):
+        return self.walk(self.create(), states.READY, states.RUNNING,
+                         states.BLOCKED)
+
+    def fire(self, act, limit=None):
+        ActivityTimer.objects.schedule(act.pk, states.READY, 0)
+        self.executor.clear()
+        return tasks.fire_timers(limit)
+
+    def test_fire(self):
+        act = self.blocked()
+
+        self.assertEqual(self.fire(act), 1)
+        self.assertEqual(self.executor.submitted,
+                         [('transit', (act.pk, states.READY, act.token_code))])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_by_limit(self):
+        acts = [self.blocked() for _ in range(3)]
+        for act in acts:
+            ActivityTimer.objects.schedule(act.pk, states.READY, 0)
+        self.executor.clear()
+
+        self.assertEqual(tasks.fire_timers(limit=2), 3)
+        self.assertEqual(sorted(args[0] for _, args
+                                in self.executor.submitted),
+                         [act.pk for act in acts])
+        self.assertFalse(ActivityTimer.objects.exists())
+
+    def test_running_is_postponed(self):
+        act = self.walk(self.create(), states.READY, states.RUNNING)
+        due = now()
+
+        self.assertEqual(self.fire(act), 0)
+        self.assertEqual(self.executor.submitted, [])
+        self.assertGreater(ActivityTimer.objects.get().due, due)
+
+    def test_dropped(self):
+        suspended = self.walk(self.create(), states.READY)
+        ActivityModel.objects.suspend_subtree(suspended.pk)
+        finished = self.walk(self.create(), states.READY, states.RUNNING,
+                             states.FINISHED)
+        gone = self.blocked()
+        ActivityModel.objects.filter(pk=gone.pk).delete()
+
+        for act in (suspended, finished, gone):
+            self.assertEqual(self.fire(act), 0)
+        self.assertEqual(self.executor.submitted, [])
+        self.assertFalse(ActivityTimer.objects.exists())
@@ -0,0 +1,55 @@
+"""
+modbpm.tests.utils
+==================
+"""
+from __future__ import absolute_import
+
+from django.test import TestCase
+
+from modbpm import tasks
+from modbpm.models import ActivityModel
+
+
+class Recorder(object):
+    """
+    Keeps engine tasks instead of publishing them, see
+    :func:`modbpm.tasks.set_executor`.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, task, args):
+        self.submitted.append((task.name.rpartition('.')[2], args))
+
+    def names(self):
+        return [name for name, _ in self.submitted]
+
+    def clear(self):
+        del self.submitted[:]
+
+
+class EngineTestCase(TestCase):
+    """
+    Engine tasks are recorded by :attr:`executor` rather than published.
+    """
+
+    def setUp(self):
+        self.executor = Recorder()
+        self.addCleanup(tasks.set_executor, tasks.set_executor(self.executor))
+
+    def create(self, parent=None, name='modbpm.tests.Activity', *args):
+        return ActivityModel.objects.create_model(name, parent, *args)
+
+    def reload(self, activity):
+        return ActivityModel.objects.get(pk=activity.pk)
+
+    def walk(self, activity, *to_states):
+        """
+        Transit ``activity`` through ``to_states``, returns it reloaded.
+        """
+        for to_state in to_states:
+            activity = self.reload(activity)
+            self.assertTrue(activity._transit(to_state),
+                            "%s -> %s" % (activity.state, to_state))
+        return self.reload(activity)
@@ -23,3 +23,73 @@ class ConstantDict(dict):
     def __setitem__(self, key, value):
         raise TypeError("'%s' object does not support item assignment"
                         % self.__class__.__name__)
+
+
+class LRUCache(object):
+    """LRUCache keeps the most recently used values, bounded by the total
+    size given for them. Values pushed out by others are handed to
+    ``on_evict``, if any::
+
+    >>> cache = LRUCache(10)
+    >>> cache.put('a', 1, size=4)
+    True
+    >>> cache.put('b', 2, size=4)
+    True
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3, size=4)
+    True
+    >>> 'b' in cache
+    False
+    >>> cache.put('d', 4, size=11)
+    False
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.size = 0
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value, size = self._entries.pop(key)
+        self._entries[key] = (value, size)
+        return value
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value, size = self._entries.pop(key)
+        self.size -= size
+        return value
+
+    def put(self, key, value, size=1):
+        """
+        Keep ``value`` under ``key``, returns False if it is larger than
+        the whole cache and is not kept.
+        """
+        if key in self._entries:
+            replaced = self.pop(key)
+            if replaced is not value:
+                self._evict(replaced)
+        if size > self.max_size:
+            return False
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (evicted, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self._evict(evicted)
+        return True
+
+    def _evict(self, value):
+        if self.on_evict is not None:
+            self.on_evict(value)
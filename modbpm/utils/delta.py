@@ -0,0 +1,107 @@
+"""
+modbpm.utils.delta
+==================
+
+Compact binary deltas between two versions of a byte string.
+
+A delta is a sequence of instructions, each one either copies a range of
+the old version or inserts literal bytes::
+
+    >>> old = 'the quick brown fox jumps over the lazy dog' * 4
+    >>> new = old.replace('lazy', 'sleepy', 1)
+    >>> patch(old, diff(old, new)) == new
+    True
+"""
+from __future__ import absolute_import
+
+import struct
+
+BLOCK_SIZE = 32
+
+_COPY = 'C'
+_INSERT = 'I'
+_COPY_STRUCT = struct.Struct('>II')
+_INSERT_STRUCT = struct.Struct('>I')
+
+
+def _match_length(old, offset, new, pos):
+    """
+    Length of the common run of ``old[offset:]`` and ``new[pos:]``.
+    """
+    length = 0
+    limit = min(len(old) - offset, len(new) - pos)
+
+    # compare block by block first, then byte by byte
+    while length + BLOCK_SIZE <= limit \
+            and old[offset + length:offset + length + BLOCK_SIZE] \
+            == new[pos + length:pos + length + BLOCK_SIZE]:
+        length += BLOCK_SIZE
+    while length < limit and old[offset + length] == new[pos + length]:
+        length += 1
+
+    return length
+
+
+def diff(old, new):
+    """
+    Compute a delta turning ``old`` into ``new``::
+
+        >>> diff('abc' * 20, 'abc' * 20)
+        'C\\x00\\x00\\x00\\x00\\x00\\x00\\x00<'
+    """
+    index = {}
+    for offset in xrange(0, len(old) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(old[offset:offset + BLOCK_SIZE], offset)
+
+    ops = []
+    literal_start = pos = 0
+    while pos + BLOCK_SIZE <= len(new):
+        offset = index.get(new[pos:pos + BLOCK_SIZE])
+        if offset is None:
+            pos += 1
+            continue
+
+        # extend the match backwards into the pending literal bytes
+        while pos > literal_start and offset > 0 \
+                and old[offset - 1] == new[pos - 1]:
+            pos -= 1
+            offset -= 1
+
+        if pos > literal_start:
+            literal = new[literal_start:pos]
+            ops.append(_INSERT + _INSERT_STRUCT.pack(len(literal)) + literal)
+
+        length = _match_length(old, offset, new, pos)
+        ops.append(_COPY + _COPY_STRUCT.pack(offset, length))
+        pos += length
+        literal_start = pos
+
+    if literal_start < len(new):
+        literal = new[literal_start:]
+        ops.append(_INSERT + _INSERT_STRUCT.pack(len(literal)) + literal)
+
+    return ''.join(ops)
+
+
+def patch(old, delta):
+    """
+    Apply ``delta`` computed by :func:`diff` to ``old``.
+    """
+    chunks = []
+    pos = 0
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == _COPY:
+            offset, length = _COPY_STRUCT.unpack_from(delta, pos)
+            pos += _COPY_STRUCT.size
+            chunks.append(old[offset:offset + length])
+        elif op == _INSERT:
+            length, = _INSERT_STRUCT.unpack_from(delta, pos)
+            pos += _INSERT_STRUCT.size
+            chunks.append(delta[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError("invalid delta instruction: %r" % op)
+
+    return ''.join(chunks)
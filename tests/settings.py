@@ -0,0 +1,22 @@
+"""
+Settings to run the tests of modbpm::
+
+    django-admin test --settings=tests.settings
+"""
+
+SECRET_KEY = 'modbpm-tests'
+
+INSTALLED_APPS = (
+    'modbpm',
+)
+
+MIDDLEWARE_CLASSES = ()
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+USE_TZ = True